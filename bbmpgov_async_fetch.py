@@ -0,0 +1,90 @@
+import asyncio
+
+import aiohttp
+
+from bbmpgov_http_fetch import FetchError, ConditionalFetcher, retry_status_codes, backoff_time_sec
+
+
+class AsyncFetchClient:
+
+    # asyncio counterpart of FetchClient: one keep-alive connection pool shared
+    # by every task of the event loop, with timeouts and jittered exponential
+    # backoff between retries
+
+    def __init__(self, connect_timeout_sec=5, read_timeout_sec=30, max_retries=5,
+                 backoff_base_sec=1, backoff_max_sec=5*60, pool_maxsize=8):
+
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout_sec, sock_read=read_timeout_sec)
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.pool_maxsize = pool_maxsize
+
+        # Sessions have to be created inside the running event loop
+        self.session = None
+
+    def open(self):
+
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                 headers={'Accept-Encoding': 'gzip, deflate'})
+
+        return self.session
+
+    def backoff_time_sec(self, retry_count):
+        return backoff_time_sec(retry_count, self.backoff_base_sec, self.backoff_max_sec)
+
+    async def get(self, url, headers=None, max_retries=-1):
+
+        # Returns (status code, headers, body). max_retries of None retries
+        # forever, -1 uses the client default
+        if max_retries == -1:
+            max_retries = self.max_retries
+
+        session = self.open()
+
+        retry_count = 0
+        while 1:
+
+            try:
+                async with session.get(url, headers=headers, allow_redirects=True) as response:
+                    if response.status not in retry_status_codes:
+                        return response.status, response.headers, await response.read()
+
+                err_str = 'HTTP %d' % (response.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                err_str = type(err).__name__
+            except aiohttp.ClientError as err:
+                raise FetchError('Unable to fetch %s: %s' % (url, err)) from err
+
+            if max_retries is not None and retry_count >= max_retries:
+                raise FetchError('Unable to fetch %s after %d retries: %s' % (url, retry_count, err_str))
+
+            wait_time_sec = self.backoff_time_sec(retry_count)
+            retry_count += 1
+
+            print('Looks like there is connection issue (%s). Retrying in %.1f secs...' % (err_str, wait_time_sec))
+            await asyncio.sleep(wait_time_sec)
+
+    async def close(self):
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncConditionalFetcher(ConditionalFetcher):
+
+    # ConditionalFetcher over an AsyncFetchClient, unchanged pages are
+    # reported as None
+
+    def __init__(self, url, fetch_client):
+        super().__init__(url, fetch_client)
+
+    async def fetch(self, max_retries=-1):
+
+        status_code, headers, html_text = await self.fetch_client.get(self.url, headers=self.build_headers(),
+                                                                      max_retries=max_retries)
+
+        return self.check_response(status_code, headers, html_text)
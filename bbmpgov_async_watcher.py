@@ -0,0 +1,306 @@
+import os
+import json
+import asyncio
+import argparse
+import logging
+import traceback
+
+from bbmpgov_http_fetch import FetchClient, FetchError
+from bbmpgov_async_fetch import AsyncFetchClient, AsyncConditionalFetcher
+from bbmpgov_chbms_history import HistoryWriter
+from bbmpgov_chbms_bed_status import BedStatusWatcher, hospital_categories, hospital_names
+from bbmpgov_notify import build_notification_dispatcher
+from bbmpgov_subscriptions import load_subscription_index
+from bbmpgov_log_pipeline import start_log_pipeline, event_logger
+from bbmpgov_availability_api import AvailabilityAPI
+from bbmpgov_covid_bulletin import (BulletinWatcher, bbmp_covid_bulletin_url, file_download_retry_time_sec)
+
+
+# Runs the bed status watcher, any number of extra bed status profiles and the
+# bulletin watcher as tasks of one event loop, instead of one process each
+
+connect_timeout_sec = 5
+read_timeout_sec = 60
+
+# A task that fails is started again after this long
+task_restart_time_sec = 60
+
+
+def profile_logger(name, log_filename):
+
+    # Every profile logs to its own file, written by a background thread
+    logger = logging.getLogger('bbmpgov_chbms.' + name)
+    logger.propagate = False
+
+    start_log_pipeline(logger, log_filename)
+
+    return logger
+
+def read_profiles(profiles_filename):
+
+    # A JSON list of profiles, each with a name and optionally bed_types,
+    # categories, wait_time_sec, history_dir, log_file, events_file, notify,
+    # subscriptions_file and api_port
+    with open(profiles_filename, 'r') as f:
+        profiles = json.load(f)
+
+    for profile in profiles:
+        if 'name' not in profile:
+            raise ValueError('Every profile in %s needs a name' % (profiles_filename))
+
+    return profiles
+
+def profile_log_file(profile):
+    return profile.get('log_file', 'bbmpgov_chbms_covid_bed_status_%s.log' % (profile['name']))
+
+def check_profiles(profiles):
+
+    # Profiles sharing a name would share a logger, and sharing a history,
+    # log or events file would interleave their writes
+    names = set()
+    paths = {}
+    for profile in profiles:
+
+        name = profile['name']
+        if name in names:
+            raise ValueError('More than one profile is named %s' % (name))
+        names.add(name)
+
+        profile_paths = [['history_dir', profile.get('history_dir')], ['log_file', profile_log_file(profile)],
+                         ['events_file', profile.get('events_file')]]
+        for key, path in profile_paths:
+            if not path:
+                continue
+
+            path_key = os.path.normcase(os.path.abspath(path))
+            if path_key in paths:
+                raise ValueError('The %s %s of profile %s is already used by profile %s' % (key, path, name, paths[path_key]))
+            paths[path_key] = name
+
+class SharedPage:
+
+    # Latest version of a page fetched by one task for every profile watching
+    # it, so that a page is downloaded once per interval however many
+    # profiles read it
+
+    def __init__(self, page_fetcher):
+
+        self.page_fetcher = page_fetcher
+        self.html_text = None
+        self.version = 0
+        self.fetched = asyncio.Event()
+
+    def read(self, seen_version):
+
+        # [page, version], the page being None if it has not changed since
+        # seen_version
+        if self.version == seen_version:
+            return None, seen_version
+
+        return self.html_text, self.version
+
+async def fetch_shared_page(shared_page, wait_time_sec):
+
+    while 1:
+
+        # Connection errors are retried until the page is in, other errors
+        # wait for the next poll
+        try:
+            html_text = await shared_page.page_fetcher.fetch(max_retries=None)
+        except FetchError as err:
+            print(err)
+            html_text = None
+
+        if html_text is not None:
+            shared_page.html_text = html_text
+            shared_page.version += 1
+            shared_page.fetched.set()
+
+        await asyncio.sleep(wait_time_sec)
+
+async def watch_bed_status(shared_page, bed_status_watcher, wait_time_sec, notification_dispatcher=None,
+                           subscription_index=None, availability_api=None):
+
+    # Wait for the first page
+    await shared_page.fetched.wait()
+    seen_version = 0
+
+    while 1:
+
+        # Nothing is parsed or compared if the page has not changed
+        html_text, seen_version = shared_page.read(seen_version)
+        hosp_categories, bed_availabiliy = bed_status_watcher.update(html_text)
+
+        if availability_api is not None:
+            availability_api.publish(bed_status_watcher.ref_snapshot)
+
+        # Sent from the dispatcher's own thread, never waited on here
+        if notification_dispatcher is not None:
+            notification_dispatcher.notify(hosp_categories, bed_availabiliy)
+            if subscription_index is not None and len(hosp_categories):
+                notification_dispatcher.notify_recipients(subscription_index.match(bed_status_watcher.ref_snapshot,
+                                                                                   hosp_categories, bed_availabiliy))
+
+        await asyncio.sleep(wait_time_sec)
+
+async def watch_bulletin(async_fetch_client, fetch_client, bulletin_watcher):
+
+    # An unchanged bulletin page only costs a 304
+    page_fetcher = AsyncConditionalFetcher(bbmp_covid_bulletin_url, async_fetch_client)
+    loop = asyncio.get_running_loop()
+
+    while 1:
+
+        # Intervals are measured from the start of each check
+        check_time = loop.time()
+
+        # Fetch the data from the url, connection errors are retried until it is in
+        try:
+            html_text = await page_fetcher.fetch(max_retries=None)
+        except FetchError as err:
+            print('Looks like there was an error (%s) in getting the data. Retrying...' % (err))
+            await asyncio.sleep(async_fetch_client.backoff_time_sec(5))
+            continue
+
+        # The downloads block, so they run off the event loop
+        wait_time_sec = await asyncio.to_thread(bulletin_watcher.update, fetch_client, html_text)
+        if wait_time_sec is None:
+            return
+
+        await asyncio.sleep(max(0, check_time + wait_time_sec - loop.time()))
+
+async def keep_running(name, task_func, *args):
+
+    # A failing task is logged and started again, the others carry on
+    while 1:
+
+        try:
+            return await task_func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            print('Task %s failed (%s), restarting in %d secs' % (name, err, task_restart_time_sec))
+            traceback.print_exc()
+
+        await asyncio.sleep(task_restart_time_sec)
+
+async def run_watchers(args):
+
+    # Pages polled by several profiles share one connection pool
+    async_fetch_client = AsyncFetchClient(connect_timeout_sec, read_timeout_sec)
+
+    profiles = [{
+        'name': 'main',
+        'bed_types': args.bed_types.split(','),
+        'wait_time_sec': args.wait_time_sec,
+        'history_dir': args.history_dir,
+        'log_file': 'bbmpgov_chbms_covid_bed_status.log',
+        'events_file': args.events_log,
+        'notify': True,
+        'subscriptions_file': args.subscriptions_file,
+        'api_port': args.api_port,
+        }]
+    if args.profiles_file:
+        profiles += read_profiles(args.profiles_file)
+    check_profiles(profiles)
+
+    tasks = []
+    shared_pages = {}
+    history_writers = []
+    notification_dispatchers = []
+    availability_apis = []
+    for profile in profiles:
+
+        name = profile['name']
+        bed_types = profile.get('bed_types', ['ICUVentl'])
+        categories = profile.get('categories', hospital_categories)
+        log_file = profile_log_file(profile)
+
+        history_writer = None
+        if profile.get('history_dir'):
+            history_writer = HistoryWriter(profile['history_dir'])
+            history_writers.append(history_writer)
+
+        profile_events_logger = None
+        if profile.get('events_file'):
+            profile_events_logger = event_logger('bbmpgov_chbms_events.' + name, profile['events_file'])
+
+        bed_status_watcher = BedStatusWatcher(bed_types, categories, history_writer, profile_logger(name, log_file),
+                                              profile_events_logger)
+        wait_time_sec = profile.get('wait_time_sec', 60)
+
+        # The page is fetched as often as the most frequent profile reads it
+        shared_page = shared_pages.get(args.url)
+        if shared_page is None:
+            shared_page = shared_pages[args.url] = [SharedPage(AsyncConditionalFetcher(args.url, async_fetch_client)), wait_time_sec]
+        shared_page[1] = min(shared_page[1], wait_time_sec)
+
+        # Subscribers only get the changes they asked for
+        subscription_index = None
+        if profile.get('subscriptions_file'):
+            subscription_index = load_subscription_index(profile['subscriptions_file'], bed_types, hospital_names,
+                                                         bed_status_watcher.logger)
+
+        notification_dispatcher = None
+        if profile.get('notify'):
+            notification_dispatcher = build_notification_dispatcher(bed_types, args.notify_url, bed_status_watcher.logger,
+                                                                    subscription_index is not None)
+            if notification_dispatcher is not None:
+                notification_dispatchers.append(notification_dispatcher)
+
+        # Every profile serving its availability needs a port of its own
+        availability_api = None
+        if profile.get('api_port'):
+            availability_api = AvailabilityAPI(hospital_names, profile['api_port'])
+            availability_apis.append(availability_api)
+
+        tasks.append(keep_running(name, watch_bed_status, shared_page[0], bed_status_watcher, wait_time_sec, notification_dispatcher,
+                                  subscription_index, availability_api))
+
+    for url, (shared_page, wait_time_sec) in shared_pages.items():
+        tasks.append(keep_running(url, fetch_shared_page, shared_page, wait_time_sec))
+
+    fetch_client = None
+    if args.bulletin_save_dir:
+        # Bulletin files are downloaded with the blocking client
+        fetch_client = FetchClient(10, 60, backoff_max_sec=file_download_retry_time_sec, pool_maxsize=args.bulletin_num_workers)
+        bulletin_watcher = BulletinWatcher(args.bulletin_tags.split(',')[0], args.bulletin_from_date, args.bulletin_save_dir,
+                                           args.bulletin_num_workers)
+        tasks.append(keep_running('bulletin', watch_bulletin, async_fetch_client, fetch_client, bulletin_watcher))
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await async_fetch_client.close()
+        if fetch_client is not None:
+            fetch_client.close()
+        for history_writer in history_writers:
+            history_writer.close()
+        for notification_dispatcher in notification_dispatchers:
+            notification_dispatcher.close(timeout=10)
+        for availability_api in availability_apis:
+            availability_api.close()
+
+
+if __name__ == "__main__":
+
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--bed_types', type=str, help='bed types to search for availability', default='ICUVentl')
+    parser.add_argument('--wait_time_sec', type=int, help='time to wait before the next query', default=60)
+    parser.add_argument('--url', type=str, help='page to fetch the bed status from', default='https://bbmpgov.com/chbms/')
+    parser.add_argument('--history_dir', type=str, help='where to record every parsed poll, empty to disable', default='bbmpgov_chbms_history')
+    parser.add_argument('--notify_url', type=str, help='endpoint to post change digests to instead of SMS, e.g. a local stand-in', default='')
+    parser.add_argument('--events_log', type=str, help='JSON lines file of snapshots and changes, empty to disable', default='bbmpgov_chbms_covid_bed_events.jsonl')
+    parser.add_argument('--api_port', type=int, help='local port to serve the current availability on, 0 to disable', default=0)
+    parser.add_argument('--subscriptions_file', type=str, help='JSON file of subscribers and the changes each wants to hear of', default='')
+    parser.add_argument('--profiles_file', type=str, help='JSON file with extra bed_types/categories profiles to watch', default='')
+    parser.add_argument('--bulletin_tags', type=str, help='the bulletin hyperlink tag to look for', default='View')
+    parser.add_argument('--bulletin_from_date', type=str, help='date to download bulletins from in YYYYMMDD format', default='today')
+    parser.add_argument('--bulletin_save_dir', type=str, help='where to save the bulletins, empty to not watch them', default='')
+    parser.add_argument('--bulletin_num_workers', type=int, help='number of bulletins to download at once', default=4)
+
+    args = parser.parse_args()
+
+    asyncio.run(run_watchers(args))
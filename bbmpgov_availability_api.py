@@ -0,0 +1,186 @@
+import json
+import hashlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bbmpgov_chbms_snapshot import category_fingerprint
+
+
+# Serves the latest bed availability of the poller over HTTP, e.g.
+# GET /availability?category=<title>&bed_type=<bed type>&min=<beds>
+# Every parameter is optional. Local dashboards and bots read from here
+# instead of each polling the CHBMS page
+
+default_api_host = '127.0.0.1'
+max_cached_responses = 256
+
+
+class AvailabilityView:
+
+    # One published snapshot and the responses built from it. A view is never
+    # changed once published, the poller swaps in a new one instead, so
+    # readers need no lock. Responses are serialised on first request and
+    # then served as is
+
+    def __init__(self, snapshot, hospital_names):
+
+        self.snapshot = snapshot
+        self.hospital_names = hospital_names
+
+        digest = hashlib.blake2b(digest_size=12)
+        digest.update(json.dumps(snapshot.bed_types).encode())
+        for title, ids, counts in zip(snapshot.categories, snapshot.hospital_ids, snapshot.bed_counts):
+            digest.update(title.encode())
+            digest.update(category_fingerprint(ids, counts))
+        self.fingerprint = digest.hexdigest()
+
+        self.responses = {}
+
+    def etag(self, query_key):
+
+        query_hash = hashlib.blake2b(repr(query_key).encode(), digest_size=6).hexdigest()
+        return '"%s-%s"' % (self.fingerprint, query_hash)
+
+    def serialise(self, category, bed_type, min_available):
+
+        snapshot = self.snapshot
+        bed_types = list(snapshot.bed_types)
+        b_idxs = list(range(len(bed_types)))
+        if bed_type is not None:
+            b_idxs = [bed_types.index(bed_type)]
+
+        categories = {}
+        for title, ids, counts in zip(snapshot.categories, snapshot.hospital_ids, snapshot.bed_counts):
+
+            if category is not None and title != category:
+                continue
+
+            counts = counts[:, b_idxs]
+            if min_available is not None:
+                keep = (counts >= min_available).any(axis=1)
+                ids, counts = ids[keep], counts[keep]
+
+            names = self.hospital_names.lookup(ids)
+            categories[title] = [[name] + row_counts for name, row_counts in zip(names.tolist(), counts.tolist())]
+
+        response = {
+            'time': round(snapshot.timestamp, 3),
+            'bed_types': [bed_types[b_idx] for b_idx in b_idxs],
+            'categories': categories,
+            }
+        return json.dumps(response, separators=(',', ':')).encode()
+
+    def response(self, category, bed_type, min_available):
+
+        # Two threads may build the same response, both are the same bytes
+        query_key = (category, bed_type, min_available)
+        body = self.responses.get(query_key)
+        if body is None:
+            body = self.serialise(category, bed_type, min_available)
+            if len(self.responses) < max_cached_responses:
+                self.responses[query_key] = body
+
+        return body
+
+
+class AvailabilityRequestHandler(BaseHTTPRequestHandler):
+
+    # self.server.availability_api is the AvailabilityAPI served
+
+    def send_body(self, status, body, content_type='application/json', etag=None):
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_body(status, json.dumps({'error': message}).encode())
+
+    def do_GET(self):
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/availability':
+            self.send_error_json(404, 'Unknown path %s' % (url.path))
+            return
+
+        # Taken once, the poller may publish a new view meanwhile
+        view = self.server.availability_api.view
+        if view is None:
+            self.send_error_json(503, 'No bed availability yet')
+            return
+
+        params = urllib.parse.parse_qs(url.query)
+        category = params.get('category', [None])[0] or None
+        bed_type = params.get('bed_type', [None])[0] or None
+        min_available = params.get('min', [None])[0] or None
+
+        if bed_type is not None and bed_type not in view.snapshot.bed_types:
+            self.send_error_json(400, 'Bed type %s is not watched' % (bed_type))
+            return
+
+        if min_available is not None:
+            try:
+                min_available = int(min_available)
+            except ValueError:
+                self.send_error_json(400, 'min must be a number')
+                return
+
+        etag = view.etag((category, bed_type, min_available))
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_body(304, b'', etag=etag)
+            return
+
+        self.send_body(200, view.response(category, bed_type, min_available), etag=etag)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        # Requests are not logged
+        pass
+
+
+class AvailabilityAPI:
+
+    # HTTP server on a thread of its own answering from the latest published
+    # snapshot. Publishing swaps one reference, so the poller never waits on
+    # readers and readers never wait on the poller
+
+    def __init__(self, hospital_names, port, host=default_api_host):
+
+        self.hospital_names = hospital_names
+        self.view = None
+
+        self.server = ThreadingHTTPServer((host, port), AvailabilityRequestHandler)
+        self.server.daemon_threads = True
+        self.server.availability_api = self
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name='availability-api', daemon=True)
+        self.thread.start()
+
+    def publish(self, snapshot):
+
+        # Called by the poller after every update, a view is only built when
+        # the snapshot changed
+        if snapshot is None or (self.view is not None and self.view.snapshot is snapshot):
+            return
+
+        view = AvailabilityView(snapshot, self.hospital_names)
+
+        # Same tables, keep the responses already serialised
+        if self.view is not None and self.view.fingerprint == view.fingerprint:
+            return
+
+        self.view = view
+
+    def close(self):
+
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import hashlib
+
+
+# Kept next to the downloaded bulletins
+manifest_filename = 'bulletin_manifest.jsonl'
+
+
+def manifest_key(date_yyyymmdd_int, filename_tag, file_id_str):
+    return (int(date_yyyymmdd_int), filename_tag, file_id_str)
+
+def file_sha1(filepath, chunk_size=64*1024):
+
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+class DownloadManifest:
+
+    # Append-only JSON lines index of the downloaded bulletins keyed by
+    # (date, filename tag, file ID). Every entry records the URL, size,
+    # content hash, ETag and download time of the file. Later lines replace
+    # earlier ones with the same key, so entries are only ever appended
+
+    def __init__(self, save_dir):
+
+        self.save_dir = save_dir
+        self.manifest_path = os.path.join(save_dir, manifest_filename)
+
+        self.entries = {}
+        self.latest_date = 0
+
+        if os.path.exists(self.manifest_path):
+            self.load()
+
+        self.manifest_file = open(self.manifest_path, 'a')
+
+    def load(self):
+
+        with open(self.manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash, the file gets downloaded again
+                    continue
+                self.add_entry(entry)
+
+    def add_entry(self, entry):
+
+        key = manifest_key(entry['date'], entry['filename_tag'], entry['file_id'])
+        self.entries[key] = entry
+
+        if entry['date'] > self.latest_date:
+            self.latest_date = entry['date']
+
+    def get(self, date_yyyymmdd_int, filename_tag, file_id_str):
+        return self.entries.get(manifest_key(date_yyyymmdd_int, filename_tag, file_id_str))
+
+    def contains(self, date_yyyymmdd_int, filename_tag, file_id_str):
+
+        # The file also has to still be there, at its recorded size
+        entry = self.get(date_yyyymmdd_int, filename_tag, file_id_str)
+        if entry is None:
+            return False
+
+        try:
+            size = os.path.getsize(os.path.join(self.save_dir, entry['filename']))
+        except OSError:
+            return False
+
+        return size == entry['size']
+
+    def add(self, date_yyyymmdd_int, filename_tag, file_id_str, filename, url, size, content_hash, etag=None,
+            download_time=None):
+
+        if download_time is None:
+            download_time = time.time()
+
+        entry = {
+            'date': int(date_yyyymmdd_int),
+            'filename_tag': filename_tag,
+            'file_id': file_id_str,
+            'filename': filename,
+            'url': url,
+            'size': size,
+            'sha1': content_hash,
+            'etag': etag,
+            'download_time': download_time,
+            }
+
+        self.manifest_file.write(json.dumps(entry) + '\n')
+        self.manifest_file.flush()
+
+        self.add_entry(entry)
+
+        return entry
+
+    def import_existing(self, saved_file_basename):
+
+        # Adds the bulletins downloaded before the manifest existed, named
+        # <basename>_<YYYYMMDD>_<filename tag>_<file ID>.pdf
+        prefix = saved_file_basename + '_'
+        for filename in os.listdir(self.save_dir):
+
+            if not filename.startswith(prefix) or not filename.endswith('.pdf'):
+                continue
+
+            name_parts = filename[len(prefix):-len('.pdf')].split('_', 2)
+            if len(name_parts) != 3 or not name_parts[0].isdigit():
+                continue
+
+            date_yyyymmdd_str, filename_tag, file_id_str = name_parts
+            if self.get(int(date_yyyymmdd_str), filename_tag, file_id_str) is not None:
+                continue
+
+            filepath = os.path.join(self.save_dir, filename)
+            self.add(int(date_yyyymmdd_str), filename_tag, file_id_str, filename, None,
+                     os.path.getsize(filepath), file_sha1(filepath), download_time=os.path.getmtime(filepath))
+
+    def close(self):
+        self.manifest_file.close()
@@ -0,0 +1,196 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pdfplumber
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from bbmpgov_bulletin_manifest import DownloadManifest
+
+
+# Extracts the tables of the downloaded bulletins into
+# <dataset_dir>/date=<YYYYMMDD>/<bulletin>.parquet, one long table per
+# bulletin with a cell per row. Every file has the same schema, whatever the
+# layout of the tables in the PDF, so the directory reads as a single
+# dataset. Bulletins already extracted, according to the checkpoint, are
+# skipped. The checkpoint starts with an underscore so dataset readers pass
+# over it
+
+checkpoint_filename = '_extract_checkpoint.json'
+num_extract_workers = 4
+
+cell_schema = pa.schema([
+    ('date', pa.int32()),
+    ('bulletin', pa.string()),
+    ('page', pa.int32()),
+    ('table', pa.int32()),
+    ('row', pa.int32()),
+    ('column', pa.string()),
+    ('value', pa.string()),
+    ])
+
+
+def cell_text(cell):
+
+    # Cells spanning several lines come out with line breaks
+    if cell is None:
+        return None
+    return ' '.join(cell.split())
+
+def column_names(header_row):
+
+    # Unique column names, so cells can be pivoted back into tables
+    names = []
+    name_counts = {}
+    for c_idx, text in enumerate(header_row):
+
+        name = text if text else 'col%d' % (c_idx)
+        if name in name_counts:
+            name_counts[name] += 1
+            name = '%s_%d' % (name, name_counts[name])
+        else:
+            name_counts[name] = 0
+
+        names.append(name)
+
+    return names
+
+def table_cells(rows):
+
+    # The first row is the header, every other cell becomes
+    # [row index, column name, text]
+    rows = [[cell_text(cell) for cell in row] for row in rows]
+
+    num_cols = max(len(row) for row in rows)
+    for row in rows:
+        row += [None] * (num_cols - len(row))
+
+    names = column_names(rows[0])
+
+    cells = []
+    for r_idx, row in enumerate(rows[1:]):
+        for name, text in zip(names, row):
+            cells.append([r_idx, name, text])
+
+    return cells
+
+def extract_pdf_cells(pdf_path):
+
+    # Columns of the cells of every table with a body
+    columns = {'page': [], 'table': [], 'row': [], 'column': [], 'value': []}
+    with pdfplumber.open(pdf_path) as pdf:
+        for p_idx, page in enumerate(pdf.pages):
+            for t_idx, rows in enumerate(page.extract_tables()):
+                if len(rows) < 2:
+                    continue
+                for r_idx, name, text in table_cells(rows):
+                    columns['page'].append(p_idx)
+                    columns['table'].append(t_idx)
+                    columns['row'].append(r_idx)
+                    columns['column'].append(name)
+                    columns['value'].append(text)
+
+    return columns
+
+def process_pdf(pdf_path, date_yyyymmdd_int, dataset_dir):
+
+    # Runs in a worker process, returns the number of tables written. An
+    # earlier version of the bulletin is replaced
+    partition_dir = os.path.join(dataset_dir, 'date=%d' % (date_yyyymmdd_int))
+    os.makedirs(partition_dir, exist_ok=True)
+
+    bulletin = os.path.splitext(os.path.basename(pdf_path))[0]
+    columns = extract_pdf_cells(pdf_path)
+
+    num_cells = len(columns['value'])
+    columns['date'] = [date_yyyymmdd_int] * num_cells
+    columns['bulletin'] = [bulletin] * num_cells
+    cells = pa.Table.from_pydict(columns, schema=cell_schema)
+
+    table_filepath = os.path.join(partition_dir, bulletin + '.parquet')
+    pq.write_table(cells, table_filepath + '.tmp')
+    os.replace(table_filepath + '.tmp', table_filepath)
+
+    return len(set(zip(columns['page'], columns['table'])))
+
+def read_checkpoint(checkpoint_path):
+
+    # Bulletin filename -> sha1 of the version extracted
+    if not os.path.exists(checkpoint_path):
+        return {}
+
+    with open(checkpoint_path, 'r') as f:
+        return json.load(f)
+
+def write_checkpoint(checkpoint_path, checkpoint):
+
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+def extract_new_bulletins(save_dir, dataset_dir, num_workers=num_extract_workers):
+
+    # Extracts the bulletins in the download manifest that are new or changed
+    # since the last run, returns the number of bulletins extracted
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    checkpoint_path = os.path.join(dataset_dir, checkpoint_filename)
+    checkpoint = read_checkpoint(checkpoint_path)
+
+    manifest = DownloadManifest(save_dir)
+    entries = list(manifest.entries.values())
+    manifest.close()
+
+    pending_entries = []
+    for entry in entries:
+        if checkpoint.get(entry['filename']) == entry['sha1']:
+            continue
+        if os.path.exists(os.path.join(save_dir, entry['filename'])):
+            pending_entries.append(entry)
+
+    if len(pending_entries) == 0:
+        print('No new bulletins to extract')
+        return 0
+
+    num_extracted = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        futures = {}
+        for entry in pending_entries:
+            pdf_path = os.path.join(save_dir, entry['filename'])
+            futures[executor.submit(process_pdf, pdf_path, entry['date'], dataset_dir)] = entry
+
+        for future in as_completed(futures):
+
+            entry = futures[future]
+            try:
+                num_tables = future.result()
+            except Exception as err:
+                # Left out of the checkpoint, so it is tried again next run
+                print('Unable to extract tables from %s: %s' % (entry['filename'], err))
+                continue
+
+            print('Extracted %d tables from %s' % (num_tables, entry['filename']))
+
+            # Saved after every bulletin so an interrupted run loses nothing
+            checkpoint[entry['filename']] = entry['sha1']
+            write_checkpoint(checkpoint_path, checkpoint)
+            num_extracted += 1
+
+    return num_extracted
+
+
+if __name__ == "__main__":
+
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--save_dir', type=str, help='where the bulletins were downloaded', default='./')
+    parser.add_argument('--dataset_dir', type=str, help='where to write the extracted tables', default='bbmp_covid_bulletin_tables')
+    parser.add_argument('--num_workers', type=int, help='number of bulletins to extract at once', default=num_extract_workers)
+
+    args = parser.parse_args()
+
+    extract_new_bulletins(args.save_dir, args.dataset_dir, args.num_workers)
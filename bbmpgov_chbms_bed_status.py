@@ -0,0 +1,347 @@
+import time
+import datetime
+import logging
+import random
+import threading
+from collections import OrderedDict
+
+from tabulate import tabulate
+
+from bbmpgov_chbms_table_extractor import extract_category_tables
+from bbmpgov_chbms_snapshot import BedSnapshot, find_snapshot_changes, category_fingerprint
+from bbmpgov_hospital_registry import HospitalRegistry
+from bbmpgov_log_pipeline import LazyMessage, snapshot_event_json, changes_event_json
+
+
+routine_output_time_th_sec = 60 * 60
+
+# Rendered category tables kept for reuse
+table_render_cache_size = 64
+
+# Tags to look for in the html page
+search_tags = [['div', 'col-md-12'], ['h4'], ['table']]
+
+
+# Hospital categories to look for
+hospital_categories = [
+    # 'Government Quota Covid-19 Beds',
+    # 'Private Arrangements By COVID-19 Patients',
+    'Government Hospitals (Covid Beds)',
+    'Government Medical Colleges (Covid Beds)',
+    'Private Hospitals (Government Quota Covid Beds)',
+    'Private Medical Colleges (Government Quota Covid Beds)',
+    # 'Government Covid Care Centers (CCC)'
+    ]
+
+
+bed_col_title = 'Net Available Beds for C+ Patients'
+hospital_col_pairs = ('Dedicated Covid Healthcare Centers (DCHCs)', 'Name of facility')
+
+# Hospital names are interned once and snapshots refer to them by ID, with
+# every spelling of a hospital getting the same ID
+hospital_names = HospitalRegistry()
+
+
+class TableRenderCache:
+
+    # LRU cache of rendered tables. Rendering happens on the log listener
+    # threads, every watcher profile having its own, hence the lock
+
+    def __init__(self, max_entries=table_render_cache_size):
+
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, render_func, *args):
+
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+                return text
+
+        # Rendered outside the lock, two threads may both render a new table
+        text = render_func(*args)
+
+        with self.lock:
+            self.entries[key] = text
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return text
+
+# Categories that did not change since the last poll are not rendered again
+rendered_tables = TableRenderCache()
+
+
+def find_req_table(table_vals, bed_types):
+
+    cond = (table_vals[(bed_col_title, bed_types[0])] > 0)
+    for bed_type in bed_types[1:]:
+        cond = cond | (table_vals[(bed_col_title, bed_type)] > 0)
+    req_table_rows = table_vals.loc[cond]
+
+    req_cols = [hospital_col_pairs]
+    for bed_type in bed_types:
+        req_cols.append((bed_col_title, bed_type))
+    req_table_cols = req_table_rows[req_cols]
+
+    sorted_table = req_table_cols.sort_values(hospital_col_pairs)
+    sorted_table.reset_index(inplace=True, drop=True)
+    
+    return sorted_table
+
+def find_tables_infos(html_text, search_tags, bed_types, hospital_categories=hospital_categories):
+    
+    table_infos = []
+
+    # Single pass over the page for the category headings and their tables
+    category_tables = extract_category_tables(html_text, search_tags, hospital_categories)
+    for cur_title, table_vals in category_tables:
+
+        table_infos.append([cur_title, find_req_table(table_vals, bed_types)])
+        
+    return table_infos
+
+def render_category_table(cur_title, hospital_ids, bed_counts, bed_types):
+
+    hosp_bed_infos = [[name] + row_counts for name, row_counts in zip(hospital_names.lookup(hospital_ids), bed_counts.tolist())]
+
+    table_header = [cur_title] + bed_types
+    return tabulate(hosp_bed_infos, headers=table_header, tablefmt='pretty', numalign="center", stralign="center")
+
+def render_cur_availability(cur_snapshot, bed_types):
+
+    heading = 'Current Availability:'
+    lines = ['{:s}\n{:s}'.format(heading, len(heading) * '-')]
+
+    for cur_title, hospital_ids, bed_counts in zip(cur_snapshot.categories, cur_snapshot.hospital_ids, cur_snapshot.bed_counts):
+
+        if len(hospital_ids) == 0:
+            continue
+
+        # Hospital IDs always map to the same displayed name, so the IDs and
+        # counts decide the rendered text
+        key = (cur_title, tuple(bed_types), category_fingerprint(hospital_ids, bed_counts))
+
+        lines.append('')
+        lines.append(rendered_tables.get(key, render_category_table, cur_title, hospital_ids, bed_counts, bed_types))
+
+    lines.append('')
+    return '\n'.join(lines)
+
+def render_change_status(hosp_categories, bed_availabiliy, bed_types):
+
+    # Print info about which in which hospital beds were freed up or occupied
+    heading = 'Recent Changes in Hospital Beds:'
+    lines = ['{:s}\n{:s}'.format(heading, len(heading) * '-')]
+
+    for hosp_category, bed_avail in zip(hosp_categories,bed_availabiliy):
+        lines.append('')
+        lines.append(tabulate(bed_avail, headers=[hosp_category]+bed_types, tablefmt='pretty', numalign="center", stralign="center"))
+
+    lines.append('')
+    return '\n'.join(lines)
+
+def output_cur_availability(cur_snapshot, bed_types, logger=logging.root):
+
+    # Tables are only formatted when the log pipeline writes them out
+    logger.info(LazyMessage(render_cur_availability, cur_snapshot, bed_types))
+
+def output_change_status(hosp_categories, bed_availabiliy, bed_types, logger=logging.root):
+
+    if len(hosp_categories) == 0:
+        return
+
+    logger.info(LazyMessage(render_change_status, hosp_categories, bed_availabiliy, bed_types))
+
+def output_date_time(logger=logging.root):
+    now = datetime.datetime.now()
+    logger.info(now.strftime('%Y-%m-%d %H:%M:%S'))
+    logger.info('')
+
+def output_cur_inc_availability_infos(cur_snapshot, hosp_categories, bed_availabiliy, bed_types, logger=logging.root):
+
+    if len(hosp_categories) == 0:
+        return
+
+    logger.info('\n')
+    output_date_time(logger)
+    output_cur_availability(cur_snapshot, bed_types, logger)
+    output_change_status(hosp_categories, bed_availabiliy, bed_types, logger)
+
+def output_availability_infos(cur_snapshot, bed_types, logger=logging.root):
+
+    logger.info('')
+    output_date_time(logger)
+    output_cur_availability(cur_snapshot, bed_types, logger)
+    return
+
+def routinely_output_availability(cur_snapshot, bed_types, ref_time_sec, logger=logging.root):
+
+    cur_time_sec = time.time()
+    time_lapsed_sec = cur_time_sec - ref_time_sec
+
+    if time_lapsed_sec >= routine_output_time_th_sec:
+        output_availability_infos(cur_snapshot, bed_types, logger)
+        return cur_time_sec
+
+    return ref_time_sec
+
+def modify_table_random(tables_infos):
+
+    num_tables = len(tables_infos)
+    if num_tables == 0:
+        return
+
+    hosp_names = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+    # Change existing value
+    # Select the table to modify
+    table_to_modify = random.choice(range(num_tables))
+    table_infos = tables_infos[table_to_modify][1]
+
+    if not table_infos.empty:
+
+        # Select column to modify
+        num_cols = len(table_infos.columns)
+        col_to_modify = random.choice(range(num_cols))
+
+        # Select row to modify
+        num_rows = len(table_infos.index)
+        row_to_modify = random.choice(range(num_rows))
+        
+        # Modify specific row and column
+        if col_to_modify == 0:
+            hosp_name = random.choice(hosp_names)
+            table_infos.iloc[row_to_modify,col_to_modify] = hosp_name
+
+            # Sort by hospital names and reassign linear indexes
+            table_infos.sort_values(hospital_col_pairs, inplace=True)
+            table_infos.reset_index(inplace=True, drop=True)
+        else:
+            avail_beds = random.choice(range(20))
+            table_infos.iloc[row_to_modify,col_to_modify] = avail_beds
+
+
+    # Add/Del new entry
+    add_entry = (random.choice(range(100)) % 2) == 0
+    if add_entry:
+
+        # Select the table to modify
+        table_to_modify = random.choice(range(num_tables))
+        table_infos = tables_infos[table_to_modify][1]
+        
+        if not table_infos.empty:
+
+            num_cols = len(table_infos.columns)
+
+            # Add new entry
+            hosp_name = random.choice(hosp_names)
+            avail_beds = random.choice(range(20))
+            table_infos.iloc[-1] = [hosp_name] + [avail_beds] * (num_cols-1)
+
+            # Sort by hospital names and reassign linear indexes
+            table_infos.sort_values(hospital_col_pairs, inplace=True)
+            table_infos.reset_index(inplace=True, drop=True)
+    else:
+
+        # Select the table to modify
+        table_to_modify = random.choice(range(num_tables))
+        table_infos = tables_infos[table_to_modify][1]
+
+        if not table_infos.empty:
+
+            # Select row to delete
+            num_rows = len(table_infos.index)
+            row_to_modify = random.choice(range(num_rows))
+
+            # Delete specific row
+            table_infos.drop([row_to_modify])
+
+            # Reassign linear indexes
+            table_infos.reset_index(inplace=True, drop=True)
+
+
+class BedStatusWatcher:
+
+    # Tracks the availability of a set of bed types and categories across
+    # polls of the CHBMS page, logging the changes as they come in
+
+    def __init__(self, bed_types, categories=hospital_categories, history_writer=None, logger=logging.root,
+                 event_logger=None):
+
+        self.bed_types = bed_types
+        self.categories = categories
+        self.history_writer = history_writer
+        self.logger = logger
+        self.event_logger = event_logger
+
+        # Hospitals recorded before keep their IDs and spellings
+        if history_writer is not None:
+            hospital_names.intern_all(history_writer.store_names.names)
+
+        self.ref_snapshot = None
+
+        # To routinely output the data
+        self.ref_time_sec = time.time()
+
+    def output_snapshot_event(self, cur_snapshot):
+
+        if self.event_logger is not None:
+            self.event_logger.info(LazyMessage(snapshot_event_json, cur_snapshot, hospital_names))
+
+    def routinely_output(self, cur_snapshot):
+
+        # The event stream gets a full snapshot whenever the log prints the
+        # full availability: on the first poll, on every change and routinely
+        ref_time_sec = self.ref_time_sec
+        self.ref_time_sec = routinely_output_availability(cur_snapshot, self.bed_types, ref_time_sec, self.logger)
+        if self.ref_time_sec != ref_time_sec:
+            self.output_snapshot_event(cur_snapshot)
+
+    def update(self, html_text):
+
+        # html_text is None when the page has not changed since the last poll
+        if html_text is None:
+            if self.ref_snapshot is not None:
+                self.routinely_output(self.ref_snapshot)
+            return [], []
+
+        # Find current hospital bed availability
+        cur_tables_infos = find_tables_infos(html_text, search_tags, self.bed_types, self.categories)
+
+        # For debugging
+        # modify_table_random(cur_tables_infos)
+
+        # Unchanged categories share their arrays with the previous snapshot
+        cur_snapshot = BedSnapshot.from_tables_infos(cur_tables_infos, self.bed_types, hospital_names, self.ref_snapshot)
+
+        # Record every parsed poll for later queries
+        if self.history_writer is not None:
+            self.history_writer.append(cur_snapshot, hospital_names)
+
+        if self.ref_snapshot is None:
+
+            # Log the results
+            output_availability_infos(cur_snapshot, self.bed_types, self.logger)
+            self.output_snapshot_event(cur_snapshot)
+            self.ref_snapshot = cur_snapshot
+            return [], []
+
+        self.routinely_output(cur_snapshot)
+
+        # Find any changes from the previous info
+        hosp_categories, bed_availabiliy = find_snapshot_changes(self.ref_snapshot, cur_snapshot, hospital_names)
+
+        # Log the results
+        output_cur_inc_availability_infos(cur_snapshot, hosp_categories, bed_availabiliy, self.bed_types, self.logger)
+        if len(hosp_categories):
+            self.output_snapshot_event(cur_snapshot)
+            if self.event_logger is not None:
+                self.event_logger.info(LazyMessage(changes_event_json, cur_snapshot, hosp_categories, bed_availabiliy))
+
+        self.ref_snapshot = cur_snapshot
+
+        return hosp_categories, bed_availabiliy
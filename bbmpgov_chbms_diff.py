@@ -0,0 +1,21 @@
+import numpy as np
+
+
+# Row status codes in a diff
+row_added = 1
+row_removed = -1
+row_changed = 0
+
+
+def list_table_changes(names, status, bed_difs):
+
+    # Added hospitals first, then removed ones, then the changed ones
+    order = np.concatenate([np.flatnonzero(status == row_added),
+                            np.flatnonzero(status == row_removed),
+                            np.flatnonzero(status == row_changed)])
+
+    hosp_beds_info = []
+    for name, bed_dif in zip(names[order], bed_difs[order].tolist()):
+        hosp_beds_info.append([name] + bed_dif)
+
+    return hosp_beds_info
@@ -0,0 +1,386 @@
+import os
+import json
+import glob
+import struct
+import datetime
+
+import numpy as np
+
+from bbmpgov_chbms_snapshot import HospitalNames, BedSnapshot
+
+
+# History layout:
+#   <history_dir>/hospital_names.txt       one JSON string per line, line number = stored ID
+#   <history_dir>/<YYYYMMDD>/records.bin   append-only records, one per parsed poll
+#   <history_dir>/<YYYYMMDD>/index.bin     fixed-width (timestamp, offset, length, kind) entries
+#
+# A record is a little-endian uint32 header length, a JSON header and the raw
+# arrays it describes. Keyframes hold every category in full, deltas only the
+# categories that changed since the previous record: in full if the hospitals
+# changed, otherwise just the positions and counts of the changed rows. Every
+# day starts with a keyframe so that partitions can be read on their own.
+
+names_filename = 'hospital_names.txt'
+records_filename = 'records.bin'
+index_filename = 'index.bin'
+
+record_keyframe = 0
+record_delta = 1
+
+index_dtype = np.dtype([('timestamp', '<f8'), ('offset', '<i8'), ('length', '<i8'), ('kind', '<i8')])
+header_len_struct = struct.Struct('<I')
+
+id_dtype = np.dtype('<i4')
+pos_dtype = np.dtype('<i4')
+
+default_keyframe_interval = 60
+
+
+def partition_name(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
+
+def encode_record(kind, snapshot, categories, arrays):
+
+    header = {
+        'kind': kind,
+        'timestamp': snapshot.timestamp,
+        'bed_types': list(snapshot.bed_types),
+        'titles': list(snapshot.categories),
+        'categories': categories,
+        }
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    chunks = [header_len_struct.pack(len(header_bytes)), header_bytes]
+    for array in arrays:
+        chunks.append(np.ascontiguousarray(array).tobytes())
+
+    return b''.join(chunks)
+
+def decode_record(record_bytes):
+
+    header_len = header_len_struct.unpack_from(record_bytes, 0)[0]
+    header_end = header_len_struct.size + header_len
+    header = json.loads(bytes(record_bytes[header_len_struct.size:header_end]).decode('utf-8'))
+
+    return header, record_bytes, header_end
+
+def apply_record(state, header, record_bytes, offset):
+
+    # state maps a category title to its (hospital IDs, bed counts) arrays
+    num_bed_types = len(header['bed_types'])
+
+    if header['kind'] == record_keyframe:
+        prev_state = {}
+    else:
+        prev_state = state
+
+    new_state = {}
+    for title in header['titles']:
+        if title in prev_state:
+            new_state[title] = prev_state[title]
+
+    for category in header['categories']:
+
+        num_rows = category['num_rows']
+        count_dtype = np.dtype(category['dtype'])
+
+        if category['mode'] == 'full':
+            ids = np.frombuffer(record_bytes, dtype=id_dtype, count=num_rows, offset=offset)
+            offset += ids.nbytes
+            counts = np.frombuffer(record_bytes, dtype=count_dtype, count=num_rows * num_bed_types, offset=offset)
+            offset += counts.nbytes
+            new_state[category['title']] = (ids, counts.reshape(num_rows, num_bed_types))
+            continue
+
+        # Only the changed rows, the hospitals are the same as before
+        positions = np.frombuffer(record_bytes, dtype=pos_dtype, count=num_rows, offset=offset)
+        offset += positions.nbytes
+        rows = np.frombuffer(record_bytes, dtype=count_dtype, count=num_rows * num_bed_types, offset=offset)
+        offset += rows.nbytes
+
+        ids, counts = prev_state[category['title']]
+        counts = counts.astype(np.result_type(counts.dtype, count_dtype))
+        counts[positions] = rows.reshape(num_rows, num_bed_types)
+        new_state[category['title']] = (ids, counts)
+
+    return new_state
+
+def state_to_snapshot(state, header):
+
+    titles = header['titles']
+    hospital_ids = [state[title][0] for title in titles]
+    bed_counts = [state[title][1] for title in titles]
+
+    return BedSnapshot(header['timestamp'], header['bed_types'], titles, hospital_ids, bed_counts)
+
+
+class HistoryWriter:
+
+    def __init__(self, history_dir, keyframe_interval=default_keyframe_interval):
+
+        self.history_dir = history_dir
+        self.keyframe_interval = keyframe_interval
+
+        os.makedirs(history_dir, exist_ok=True)
+
+        # Stored hospital IDs are independent of the IDs used by the poller
+        names_path = os.path.join(history_dir, names_filename)
+        self.store_names = read_hospital_names(names_path)[0]
+        self.names_file = open(names_path, 'a', encoding='utf-8')
+        self.id_map = np.zeros(0, dtype=id_dtype)
+
+        self.partition = None
+        self.records_file = None
+        self.index_file = None
+
+        self.prev_snapshot = None
+        self.num_deltas = 0
+
+    def store_ids(self, ids, hospital_names):
+
+        # Extend the poller ID -> stored ID map with any new hospitals
+        num_mapped = len(self.id_map)
+        if num_mapped < len(hospital_names.names):
+            new_ids = []
+            for name in hospital_names.names[num_mapped:]:
+                num_stored = len(self.store_names.names)
+                store_id = self.store_names.intern(name)
+                if store_id == num_stored:
+                    self.names_file.write(json.dumps(name) + '\n')
+                new_ids.append(store_id)
+
+            # Names must be on disk before any record refers to them
+            self.names_file.flush()
+            self.id_map = np.concatenate([self.id_map, np.array(new_ids, dtype=id_dtype)])
+
+        return self.id_map[ids]
+
+    def open_partition(self, timestamp):
+
+        partition = partition_name(timestamp)
+        if partition == self.partition:
+            return False
+
+        self.close_partition()
+
+        partition_dir = os.path.join(self.history_dir, partition)
+        os.makedirs(partition_dir, exist_ok=True)
+
+        self.records_file = open(os.path.join(partition_dir, records_filename), 'ab')
+        self.index_file = open(os.path.join(partition_dir, index_filename), 'ab')
+        self.partition = partition
+
+        # A partly written last index entry, left by a crash, would misalign
+        # every entry appended after it. Its record is orphaned either way
+        index_size = self.index_file.seek(0, os.SEEK_END)
+        if index_size % index_dtype.itemsize:
+            self.index_file.truncate(index_size - index_size % index_dtype.itemsize)
+
+        return True
+
+    def close_partition(self):
+
+        if self.records_file is not None:
+            self.records_file.close()
+            self.index_file.close()
+
+        self.records_file = None
+        self.index_file = None
+
+    def encode_keyframe(self, snapshot, hospital_names):
+
+        categories = []
+        arrays = []
+        for title, ids, counts in zip(snapshot.categories, snapshot.hospital_ids, snapshot.bed_counts):
+            categories.append({'title': title, 'mode': 'full', 'num_rows': len(ids), 'dtype': counts.dtype.str})
+            arrays += [self.store_ids(ids, hospital_names).astype(id_dtype), counts]
+
+        return encode_record(record_keyframe, snapshot, categories, arrays)
+
+    def encode_delta(self, snapshot, hospital_names):
+
+        categories = []
+        arrays = []
+        for title, ids, counts in zip(snapshot.categories, snapshot.hospital_ids, snapshot.bed_counts):
+
+            prev = self.prev_snapshot.category(title)
+            if prev is not None and prev[0] is ids and prev[1] is counts:
+                continue
+
+            # Same hospitals in the same order, store only the changed rows
+            if prev is not None and np.array_equal(prev[0], ids) and prev[1].shape == counts.shape:
+                positions = np.flatnonzero((prev[1] != counts).any(axis=1)).astype(pos_dtype)
+                if len(positions) == 0:
+                    continue
+                categories.append({'title': title, 'mode': 'rows', 'num_rows': len(positions), 'dtype': counts.dtype.str})
+                arrays += [positions, counts[positions]]
+                continue
+
+            categories.append({'title': title, 'mode': 'full', 'num_rows': len(ids), 'dtype': counts.dtype.str})
+            arrays += [self.store_ids(ids, hospital_names).astype(id_dtype), counts]
+
+        return encode_record(record_delta, snapshot, categories, arrays)
+
+    def append(self, snapshot, hospital_names):
+
+        new_partition = self.open_partition(snapshot.timestamp)
+
+        use_keyframe = (new_partition or self.prev_snapshot is None
+                        or self.num_deltas >= self.keyframe_interval
+                        or self.prev_snapshot.bed_types != snapshot.bed_types)
+
+        if use_keyframe:
+            kind = record_keyframe
+            record_bytes = self.encode_keyframe(snapshot, hospital_names)
+            self.num_deltas = 0
+        else:
+            kind = record_delta
+            record_bytes = self.encode_delta(snapshot, hospital_names)
+            self.num_deltas += 1
+
+        # The index entry is only written once its record is complete
+        offset = self.records_file.seek(0, os.SEEK_END)
+        self.records_file.write(record_bytes)
+        self.records_file.flush()
+
+        index_entry = np.array([(snapshot.timestamp, offset, len(record_bytes), kind)], dtype=index_dtype)
+        self.index_file.write(index_entry.tobytes())
+        self.index_file.flush()
+
+        self.prev_snapshot = snapshot
+
+    def close(self):
+        self.close_partition()
+        self.names_file.close()
+
+
+def read_hospital_names(names_path, hospital_names=None, offset=0):
+
+    # Reads the names appended after offset, returns the names and the new offset
+    if hospital_names is None:
+        hospital_names = HospitalNames()
+
+    if not os.path.exists(names_path):
+        return hospital_names, offset
+
+    with open(names_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            # A partly written last line is picked up on the next read
+            if not line.endswith(b'\n'):
+                break
+            hospital_names.intern(json.loads(line.decode('utf-8')))
+            offset += len(line)
+
+    return hospital_names, offset
+
+
+class HistoryReader:
+
+    def __init__(self, history_dir):
+
+        self.history_dir = history_dir
+        self.names_path = os.path.join(history_dir, names_filename)
+        self.hospital_names, self.names_offset = read_hospital_names(self.names_path)
+
+        # Memory mapped records of the partitions read so far
+        self.records = {}
+
+    def refresh_names(self):
+        self.hospital_names, self.names_offset = read_hospital_names(self.names_path, self.hospital_names, self.names_offset)
+
+    def partitions(self):
+
+        partition_dirs = glob.glob(os.path.join(self.history_dir, '[0-9]' * 8))
+        return sorted(os.path.basename(partition_dir) for partition_dir in partition_dirs)
+
+    def read_index(self, partition):
+
+        index_path = os.path.join(self.history_dir, partition, index_filename)
+        if not os.path.exists(index_path):
+            return np.zeros(0, dtype=index_dtype)
+
+        # Ignore a partly written last entry
+        num_entries = os.path.getsize(index_path) // index_dtype.itemsize
+        if num_entries == 0:
+            return np.zeros(0, dtype=index_dtype)
+
+        return np.memmap(index_path, dtype=index_dtype, mode='r', shape=(num_entries,))
+
+    def read_record(self, partition, index_entry):
+
+        records_path = os.path.join(self.history_dir, partition, records_filename)
+
+        # Remap when the file has grown past the current mapping
+        offset = int(index_entry['offset'])
+        end = offset + int(index_entry['length'])
+        records = self.records.get(partition)
+        if records is None or len(records) < end:
+            records = np.memmap(records_path, dtype=np.uint8, mode='r')
+            self.records[partition] = records
+
+        return decode_record(records[offset:end])
+
+    def decode_range(self, partition, index, first_idx, last_idx, state=None):
+
+        # Applies the records first_idx..last_idx of a partition in order
+        for r_idx in range(first_idx, last_idx + 1):
+            header, record_bytes, offset = self.read_record(partition, index[r_idx])
+            state = apply_record(state if state is not None else {}, header, record_bytes, offset)
+
+        return state, header
+
+    def snapshot_at(self, timestamp):
+
+        # State as of timestamp: the latest record at or before it, rebuilt from
+        # the keyframe preceding that record
+        partitions = [partition for partition in self.partitions() if partition <= partition_name(timestamp)]
+
+        for partition in partitions[::-1]:
+
+            index = self.read_index(partition)
+            r_idx = int(np.searchsorted(index['timestamp'], timestamp, side='right')) - 1
+            if r_idx < 0:
+                continue
+
+            keyframe_idxs = np.flatnonzero(index['kind'][:r_idx + 1] == record_keyframe)
+            state, header = self.decode_range(partition, index, int(keyframe_idxs[-1]), r_idx)
+
+            self.refresh_names()
+            return state_to_snapshot(state, header)
+
+        return None
+
+    def iter_snapshots(self, start_timestamp=None, end_timestamp=None):
+
+        # Every recorded snapshot in [start_timestamp, end_timestamp], in order
+        self.refresh_names()
+
+        for partition in self.partitions():
+
+            if start_timestamp is not None and partition < partition_name(start_timestamp):
+                continue
+            if end_timestamp is not None and partition > partition_name(end_timestamp):
+                break
+
+            index = self.read_index(partition)
+            if len(index) == 0:
+                continue
+
+            first_idx = 0
+            if start_timestamp is not None:
+                first_idx = int(np.searchsorted(index['timestamp'], start_timestamp, side='left'))
+            last_idx = len(index) - 1
+            if end_timestamp is not None:
+                last_idx = int(np.searchsorted(index['timestamp'], end_timestamp, side='right')) - 1
+            if first_idx > last_idx:
+                continue
+
+            # Start from the keyframe preceding the first wanted record
+            keyframe_idxs = np.flatnonzero(index['kind'][:first_idx + 1] == record_keyframe)
+            state = None
+            for r_idx in range(int(keyframe_idxs[-1]), last_idx + 1):
+                header, record_bytes, offset = self.read_record(partition, index[r_idx])
+                state = apply_record(state if state is not None else {}, header, record_bytes, offset)
+                if r_idx >= first_idx:
+                    yield state_to_snapshot(state, header)
@@ -0,0 +1,208 @@
+import argparse
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+from bbmpgov_chbms_history import HistoryReader
+from bbmpgov_chbms_snapshot import BedSnapshot
+from bbmpgov_hospital_registry import normalise_hospital_name
+
+
+def to_timestamp(date_time):
+
+    # Accepts unix seconds, datetimes and 'YYYY-mm-dd HH:MM[:SS]' strings in local time
+    if date_time is None or isinstance(date_time, (int, float)):
+        return date_time
+    if isinstance(date_time, str):
+        date_time = pd.Timestamp(date_time).to_pydatetime()
+
+    return date_time.timestamp()
+
+def iter_range_snapshots(reader, start_timestamp, end_timestamp):
+
+    snapshots = reader.iter_snapshots(start_timestamp, end_timestamp)
+    if start_timestamp is None:
+        return snapshots
+
+    # The state recorded before the start still holds at the start
+    start_snapshot = reader.snapshot_at(start_timestamp)
+    if start_snapshot is None or start_snapshot.timestamp == start_timestamp:
+        return snapshots
+
+    start_snapshot = BedSnapshot(start_timestamp, start_snapshot.bed_types, start_snapshot.categories,
+                                 start_snapshot.hospital_ids, start_snapshot.bed_counts)
+
+    return itertools.chain([start_snapshot], snapshots)
+
+def load_availability(reader, start=None, end=None, bed_types=None, categories=None, hospitals=None):
+
+    # Long format (timestamp, category, hospital_id, bed_type, available) of
+    # every recorded snapshot in [start, end]. Only the partitions and records
+    # covering the range are read
+    timestamps = []
+    record_cols = [[], [], [], [], []]
+
+    hospital_ids = None
+    if hospitals is not None:
+        # Every recorded spelling of the hospitals asked for
+        reader.refresh_names()
+        hospital_keys = set(normalise_hospital_name(name) for name in hospitals)
+        hospital_ids = np.array([h_id for h_id, name in enumerate(reader.hospital_names.names)
+                                 if normalise_hospital_name(name) in hospital_keys], dtype=int)
+
+    for snapshot in iter_range_snapshots(reader, to_timestamp(start), to_timestamp(end)):
+
+        t_idx = len(timestamps)
+        timestamps.append(snapshot.timestamp)
+
+        bed_idxs = np.arange(len(snapshot.bed_types))
+        if bed_types is not None:
+            bed_idxs = np.array([b_idx for b_idx, bed_type in enumerate(snapshot.bed_types) if bed_type in bed_types], dtype=int)
+
+        for title, ids, counts in zip(snapshot.categories, snapshot.hospital_ids, snapshot.bed_counts):
+
+            if categories is not None and title not in categories:
+                continue
+
+            rows = np.ones(len(ids), dtype=bool)
+            if hospital_ids is not None:
+                rows = np.isin(ids, hospital_ids)
+
+            sel_ids = ids[rows]
+            sel_counts = counts[rows][:, bed_idxs]
+
+            # One entry per (hospital, bed type)
+            num_entries = sel_counts.size
+            record_cols[0].append(np.full(num_entries, t_idx))
+            record_cols[1].append(np.full(num_entries, title, dtype=object))
+            record_cols[2].append(np.repeat(sel_ids, len(bed_idxs)))
+            record_cols[3].append(np.tile(np.array(snapshot.bed_types, dtype=object)[bed_idxs], len(sel_ids)))
+            record_cols[4].append(sel_counts.ravel())
+
+    # Snapshots are in local time, the same as the history partitions
+    time_index = pd.DatetimeIndex([datetime.datetime.fromtimestamp(ts) for ts in timestamps], name='timestamp')
+
+    if len(record_cols[0]) == 0:
+        return time_index, pd.DataFrame(columns=['timestamp', 'category', 'hospital_id', 'bed_type', 'available'])
+
+    t_idxs = np.concatenate(record_cols[0])
+    availability = pd.DataFrame({
+        'timestamp': time_index[t_idxs],
+        'category': np.concatenate(record_cols[1]),
+        'hospital_id': np.concatenate(record_cols[2]),
+        'bed_type': np.concatenate(record_cols[3]),
+        'available': np.concatenate(record_cols[4]).astype(np.int64),
+        })
+
+    return time_index, availability
+
+def hospital_time_series(reader, start=None, end=None, bed_types=None, categories=None, hospitals=None):
+
+    # Timestamp x (category, hospital, bed type) frame of available beds
+    time_index, availability = load_availability(reader, start, end, bed_types, categories, hospitals)
+    if availability.empty:
+        return pd.DataFrame(index=time_index)
+
+    series = availability.pivot_table(index='timestamp', columns=['category', 'hospital_id', 'bed_type'],
+                                      values='available', aggfunc='sum')
+
+    # Hospitals drop off the page when they have no beds, so gaps are zeros
+    series = series.reindex(time_index).fillna(0).astype(np.int64)
+
+    names = reader.hospital_names.names
+    series.columns = pd.MultiIndex.from_tuples([(category, names[h_id], bed_type) for category, h_id, bed_type in series.columns],
+                                               names=['category', 'hospital', 'bed_type'])
+
+    return series
+
+def category_time_series(reader, start=None, end=None, bed_types=None, categories=None):
+
+    # Timestamp x (category, bed type) frame of available beds
+    time_index, availability = load_availability(reader, start, end, bed_types, categories)
+    if availability.empty:
+        return pd.DataFrame(index=time_index)
+
+    series = availability.pivot_table(index='timestamp', columns=['category', 'bed_type'],
+                                      values='available', aggfunc='sum')
+
+    return series.reindex(time_index).fillna(0).astype(np.int64)
+
+def regular_time_series(series, freq='5min'):
+
+    # A snapshot is recorded for every poll that parsed the page, polls that
+    # found the page unchanged record nothing, so records are irregularly
+    # spaced and the last value holds until the next record
+    return series.resample(freq).last().ffill()
+
+def rolling_availability(series, window='1h', freq='5min'):
+
+    # Rolling min/max/mean of every column over a time window
+    regular = regular_time_series(series, freq)
+    rolling = regular.rolling(window)
+
+    return pd.concat({'min': rolling.min(), 'max': rolling.max(), 'mean': rolling.mean()}, axis=1)
+
+def time_to_zero(series):
+
+    # For every record, the time until each column next reaches zero beds
+    # (NaT if it never does within the series)
+    times = series.index.values
+    vals = series.to_numpy()
+
+    zero_times = np.where(vals == 0, times[:, None], np.datetime64('NaT'))
+
+    # Backward fill of the next zero time, one pass per column
+    next_zero = pd.DataFrame(zero_times).bfill().to_numpy(dtype='datetime64[ns]')
+
+    return pd.DataFrame(next_zero - times[:, None], index=series.index, columns=series.columns)
+
+def beds_freed_per_hour(series):
+
+    # Beds becoming available (positive changes only) summed per hour
+    changes = series.diff()
+    return changes.clip(lower=0).resample('1h').sum().astype(np.int64)
+
+def beds_occupied_per_hour(series):
+
+    changes = series.diff()
+    return (-changes.clip(upper=0)).resample('1h').sum().astype(np.int64)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--history_dir', type=str, help='where the polls were recorded', default='bbmpgov_chbms_history')
+    parser.add_argument('--start', type=str, help='start time, YYYY-mm-dd HH:MM', default=None)
+    parser.add_argument('--end', type=str, help='end time, YYYY-mm-dd HH:MM', default=None)
+    parser.add_argument('--bed_types', type=str, help='bed types to query', default='ICUVentl')
+    parser.add_argument('--categories', type=str, help='hospital categories to query, | separated', default=None)
+    parser.add_argument('--hospitals', type=str, help='hospitals to query, | separated; per category totals if not given', default=None)
+    parser.add_argument('--stat', type=str, help='series, rolling, time_to_zero or freed_per_hour', default='series')
+    parser.add_argument('--window', type=str, help='rolling window', default='1h')
+
+    args = parser.parse_args()
+
+    reader = HistoryReader(args.history_dir)
+
+    bed_types = args.bed_types.split(',')
+    categories = args.categories.split('|') if args.categories else None
+
+    if args.hospitals:
+        series = hospital_time_series(reader, args.start, args.end, bed_types, categories, args.hospitals.split('|'))
+    else:
+        series = category_time_series(reader, args.start, args.end, bed_types, categories)
+
+    if args.stat == 'rolling':
+        result = rolling_availability(series, args.window)
+    elif args.stat == 'time_to_zero':
+        result = time_to_zero(series)
+    elif args.stat == 'freed_per_hour':
+        result = beds_freed_per_hour(series)
+    else:
+        result = series
+
+    print(tabulate(result, headers='keys', tablefmt='pretty'))
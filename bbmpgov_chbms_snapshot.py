@@ -0,0 +1,218 @@
+import time
+import hashlib
+
+import numpy as np
+
+from bbmpgov_chbms_diff import row_added, row_removed, row_changed, list_table_changes
+
+
+# Occurrence numbers of repeated hospitals are packed below the hospital ID
+occurrence_bits = 16
+
+
+class HospitalNames:
+
+    # Interns hospital names, every name gets a small integer ID the first
+    # time it is seen and keeps it for the life of the table
+
+    __slots__ = ('name_ids', 'names')
+
+    def __init__(self):
+        self.name_ids = {}
+        self.names = []
+
+    def intern(self, name):
+
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.names.append(name)
+
+        return name_id
+
+    def intern_all(self, names):
+        return np.fromiter((self.intern(name) for name in names), dtype=np.int32, count=len(names))
+
+    def lookup(self, name_ids):
+        return np.array([self.names[name_id] for name_id in name_ids], dtype=object)
+
+
+def count_dtype(bed_counts):
+
+    # Bed counts nearly always fit in 16 bits
+    if bed_counts.size == 0 or np.abs(bed_counts).max() < 2 ** 15:
+        return np.int16
+    return np.int32
+
+def category_fingerprint(hospital_ids, bed_counts):
+
+    # Content hash of one category's table, equal tables hash the same
+    # whatever the arrays they are held in
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(hospital_ids.astype(np.int32).tobytes())
+    digest.update(str(bed_counts.shape).encode())
+    digest.update(bed_counts.astype(np.int32).tobytes())
+
+    return digest.digest()
+
+def row_keys(hospital_ids):
+
+    # Pack (hospital ID, occurrence number) into one sortable integer key so
+    # that repeated hospitals are matched up in order
+    num_rows = len(hospital_ids)
+    order = np.argsort(hospital_ids, kind='stable')
+    sorted_ids = hospital_ids[order]
+
+    run_starts = np.ones(num_rows, dtype=bool)
+    run_starts[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    row_idxs = np.arange(num_rows)
+    sorted_occurrences = row_idxs - np.maximum.accumulate(np.where(run_starts, row_idxs, 0))
+
+    occurrences = np.empty(num_rows, dtype=np.int64)
+    occurrences[order] = sorted_occurrences
+
+    return (hospital_ids.astype(np.int64) << occurrence_bits) | occurrences
+
+def diff_category_counts(ref_ids, ref_counts, cur_ids, cur_counts):
+
+    # Returns the hospital IDs, their status and the bed count changes
+    # (current - reference) for every row that differs
+    ref_keys = row_keys(ref_ids)
+    cur_keys = row_keys(cur_ids)
+    keys = np.union1d(ref_keys, cur_keys)
+
+    num_bed_types = cur_counts.shape[1]
+    ref_pos = np.searchsorted(keys, ref_keys)
+    cur_pos = np.searchsorted(keys, cur_keys)
+
+    # Hospitals missing from either side count as zero beds there
+    ref_full = np.zeros((len(keys), num_bed_types), dtype=np.int32)
+    ref_full[ref_pos] = ref_counts
+    cur_full = np.zeros((len(keys), num_bed_types), dtype=np.int32)
+    cur_full[cur_pos] = cur_counts
+    bed_difs = cur_full - ref_full
+
+    status = np.full(len(keys), row_changed, dtype=np.int8)
+    in_ref = np.zeros(len(keys), dtype=bool)
+    in_ref[ref_pos] = True
+    in_cur = np.zeros(len(keys), dtype=bool)
+    in_cur[cur_pos] = True
+    status[~in_ref] = row_added
+    status[~in_cur] = row_removed
+
+    # Drop the hospitals present on both sides with no change
+    valid = (status != row_changed) | bed_difs.any(axis=1)
+
+    return (keys[valid] >> occurrence_bits).astype(np.int32), status[valid], bed_difs[valid]
+
+
+class BedSnapshot:
+
+    # Bed availability of one poll: per category, the interned hospital IDs and
+    # a hospitals x bed types matrix of counts. Snapshots are never modified
+    # once built, so unchanged categories share their arrays with the previous
+    # snapshot
+
+    __slots__ = ('timestamp', 'bed_types', 'categories', 'hospital_ids', 'bed_counts', 'category_idxs')
+
+    def __init__(self, timestamp, bed_types, categories, hospital_ids, bed_counts):
+
+        self.timestamp = timestamp
+        self.bed_types = tuple(bed_types)
+        self.categories = tuple(categories)
+        self.hospital_ids = tuple(hospital_ids)
+        self.bed_counts = tuple(bed_counts)
+
+        self.category_idxs = {}
+        for c_idx, category in enumerate(self.categories):
+            self.category_idxs[category] = c_idx
+
+    @classmethod
+    def from_tables_infos(cls, tables_infos, bed_types, hospital_names, prev_snapshot=None, timestamp=None):
+
+        # Tables hold the hospital name in the first column and the bed counts
+        # of bed_types in the rest
+        if timestamp is None:
+            timestamp = time.time()
+
+        categories = []
+        hospital_ids = []
+        bed_counts = []
+
+        for title, table in tables_infos:
+
+            ids = hospital_names.intern_all(table.iloc[:, 0].tolist())
+            counts = table.iloc[:, 1:].fillna(0).to_numpy(dtype=np.int64)
+            counts = counts.astype(count_dtype(counts))
+
+            # Share the arrays of categories that did not change
+            if prev_snapshot is not None:
+                prev = prev_snapshot.category(title)
+                if prev is not None and np.array_equal(prev[0], ids) and np.array_equal(prev[1], counts):
+                    ids, counts = prev
+
+            categories.append(title)
+            hospital_ids.append(ids)
+            bed_counts.append(counts)
+
+        return cls(timestamp, bed_types, categories, hospital_ids, bed_counts)
+
+    def category(self, title):
+
+        c_idx = self.category_idxs.get(title)
+        if c_idx is None:
+            return None
+
+        return self.hospital_ids[c_idx], self.bed_counts[c_idx]
+
+    def tables_rows(self, hospital_names):
+
+        # [title, rows] per category, each row being [hospital name] + bed counts
+        tables_rows = []
+        for title, ids, counts in zip(self.categories, self.hospital_ids, self.bed_counts):
+            rows = [[name] + row_counts for name, row_counts in zip(hospital_names.lookup(ids), counts.tolist())]
+            tables_rows.append([title, rows])
+
+        return tables_rows
+
+    def nbytes(self):
+        return sum(ids.nbytes + counts.nbytes for ids, counts in zip(self.hospital_ids, self.bed_counts))
+
+
+def find_snapshot_changes(ref_snapshot, cur_snapshot, hospital_names):
+
+    # Returns the changed categories and, per category, the [hospital name,
+    # bed changes...] rows of list_table_changes()
+    if ref_snapshot.bed_types != cur_snapshot.bed_types:
+        raise ValueError('Snapshots with different bed types cannot be compared')
+
+    avail_hosp_categories = []
+    hosp_beds_infos = []
+
+    # Only categories present in both polls are compared
+    for title, cur_ids, cur_counts in zip(cur_snapshot.categories, cur_snapshot.hospital_ids, cur_snapshot.bed_counts):
+
+        ref = ref_snapshot.category(title)
+        if ref is None:
+            continue
+
+        # Shared or equal arrays mean no change
+        ref_ids, ref_counts = ref
+        if ref_ids is cur_ids and ref_counts is cur_counts:
+            continue
+        if np.array_equal(ref_ids, cur_ids) and np.array_equal(ref_counts, cur_counts):
+            continue
+
+        ids, status, bed_difs = diff_category_counts(ref_ids, ref_counts, cur_ids, cur_counts)
+
+        # Within each group rows are listed by hospital name
+        names = hospital_names.lookup(ids)
+        name_order = np.argsort(names, kind='stable')
+
+        hosp_beds_info = list_table_changes(names[name_order], status[name_order], bed_difs[name_order])
+        if len(hosp_beds_info):
+            hosp_beds_infos.append(hosp_beds_info)
+            avail_hosp_categories.append(title)
+
+    return avail_hosp_categories, hosp_beds_infos
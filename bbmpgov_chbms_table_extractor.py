@@ -0,0 +1,227 @@
+import re
+from io import BytesIO
+
+from lxml import etree
+import pandas as pd
+
+
+# Cell text is whitespace normalised the same way pd.read_html does it
+whitespace_re = re.compile(r'\s+')
+
+# Category titles are also looked up without case and punctuation
+punctuation_re = re.compile(r'[^\w\s]')
+
+
+def element_text(elem):
+    return whitespace_re.sub(' ', ''.join(elem.itertext())).strip()
+
+def has_class(elem, class_name):
+    return class_name in elem.get('class', '').split()
+
+def read_span(elem, attr_name):
+
+    try:
+        return max(1, int(elem.get(attr_name, 1)))
+    except ValueError:
+        return 1
+
+def expand_spans(rows):
+
+    # Lay out rows of (text, rowspan, colspan) cells on a grid, repeating
+    # spanned cells the same way pd.read_html does
+    grid = []
+    pending = {}
+
+    for row in rows:
+
+        grid_row = []
+        c_idx = 0
+        cells = iter(row)
+        while 1:
+
+            # Cells carried down from rows above take precedence
+            if c_idx in pending:
+                text, rows_left = pending[c_idx]
+                grid_row.append(text)
+                if rows_left > 1:
+                    pending[c_idx] = [text, rows_left - 1]
+                else:
+                    del pending[c_idx]
+                c_idx += 1
+                continue
+
+            cell = next(cells, None)
+            if cell is None:
+                break
+
+            text, rowspan, colspan = cell
+            for s_idx in range(colspan):
+                grid_row.append(text)
+                if rowspan > 1:
+                    pending[c_idx] = [text, rowspan - 1]
+                c_idx += 1
+
+        # Spans reaching past the last cell of this row
+        for p_idx in sorted(idx for idx in pending if idx >= c_idx):
+            text, rows_left = pending[p_idx]
+            grid_row += [None] * (p_idx - len(grid_row)) + [text]
+            if rows_left > 1:
+                pending[p_idx] = [text, rows_left - 1]
+            else:
+                del pending[p_idx]
+
+        grid.append(grid_row)
+
+    return grid
+
+def build_column(vals):
+
+    # Integers first, then floats, otherwise keep the text
+    num_vals = []
+    for val in vals:
+        if val is None or val == '':
+            num_vals.append(None)
+            continue
+        num_vals.append(val.replace(',', ''))
+
+    for conv_type in (int, float):
+        try:
+            typed_vals = [None if val is None else conv_type(val) for val in num_vals]
+        except ValueError:
+            continue
+
+        if conv_type is int and None not in typed_vals:
+            return pd.Series(typed_vals, dtype='int64')
+        return pd.Series(typed_vals, dtype='float64')
+
+    return pd.Series([None if val == '' else val for val in vals], dtype='object')
+
+def build_table(header_rows, body_rows):
+
+    header_grid = expand_spans(header_rows)
+    body_grid = expand_spans(body_rows)
+
+    num_cols = max([len(row) for row in header_grid + body_grid] + [0])
+
+    # Pad ragged rows so that every column has a value for each row
+    for row in header_grid + body_grid:
+        row += [None] * (num_cols - len(row))
+
+    if len(header_grid) == 0:
+        columns = list(range(num_cols))
+    elif len(header_grid) == 1:
+        columns = header_grid[0]
+    else:
+        columns = pd.MultiIndex.from_tuples(list(zip(*header_grid)))
+
+    col_vals = list(zip(*body_grid)) if len(body_grid) else [()] * num_cols
+    table_vals = pd.concat([build_column(list(vals)) for vals in col_vals], axis=1) if num_cols else pd.DataFrame()
+    table_vals.columns = columns
+
+    return table_vals
+
+def read_table(table_elem):
+
+    header_rows = []
+    body_rows = []
+
+    for tr in table_elem.iter('tr'):
+
+        cells = [[element_text(cell), read_span(cell, 'rowspan'), read_span(cell, 'colspan')]
+                 for cell in tr if cell.tag in ('td', 'th')]
+        if len(cells) == 0:
+            continue
+
+        # Rows in a thead, or leading rows made up only of th cells, form the header
+        in_thead = tr.getparent().tag == 'thead'
+        all_th = all(cell.tag == 'th' for cell in tr if cell.tag in ('td', 'th'))
+        if in_thead or (all_th and len(body_rows) == 0):
+            header_rows.append(cells)
+        else:
+            body_rows.append(cells)
+
+    return build_table(header_rows, body_rows)
+
+def normalise_title(title):
+    return ' '.join(punctuation_re.sub(' ', title.lower()).split())
+
+def build_category_index(hospital_categories):
+
+    # Exact titles and their normalised forms both map to the category title
+    category_index = {}
+    for title in hospital_categories:
+        category_index[title] = title
+        category_index.setdefault(normalise_title(title), title)
+
+    return category_index
+
+def find_category(category_index, heading_text):
+
+    title = category_index.get(heading_text)
+    if title is None:
+        title = category_index.get(normalise_title(heading_text))
+
+    return title
+
+def extract_category_tables(html_text, search_tags, hospital_categories):
+
+    # Walk the document once, linking every category heading inside a block
+    # (div.col-md-12) to the first table that follows it in the same block
+    if isinstance(html_text, str):
+        html_text = html_text.encode('utf-8')
+
+    category_index = build_category_index(hospital_categories)
+
+    block_tag, block_class = search_tags[0]
+    heading_tag = search_tags[1][0]
+    table_tag = search_tags[2][0]
+
+    category_tables = []
+    found_titles = set()
+
+    # Open blocks, each with the category titles still waiting for a table
+    open_blocks = []
+    table_depth = 0
+
+    events = etree.iterparse(BytesIO(html_text), events=('start', 'end'), html=True, recover=True)
+    for event, elem in events:
+
+        tag = elem.tag
+        if not isinstance(tag, str):
+            continue
+
+        if event == 'start':
+            if tag == block_tag and has_class(elem, block_class):
+                open_blocks.append([elem, []])
+            elif tag == table_tag:
+                table_depth += 1
+            continue
+
+        if tag == heading_tag and len(open_blocks) and table_depth == 0:
+            title = find_category(category_index, element_text(elem))
+            if title is not None and title not in found_titles:
+                found_titles.add(title)
+                open_blocks[-1][1].append(title)
+            elem.clear()
+
+        elif tag == table_tag:
+            table_depth -= 1
+
+            # Nested tables are read as part of their outer table, and tables
+            # nobody is waiting for are never built
+            if table_depth == 0:
+                if len(open_blocks) and len(open_blocks[-1][1]):
+                    table_vals = read_table(elem)
+                    for title in open_blocks[-1][1]:
+                        category_tables.append([title, table_vals])
+                    open_blocks[-1][1] = []
+                elem.clear()
+
+        elif len(open_blocks) and open_blocks[-1][0] is elem:
+
+            # Headings left without a table may still find one in the outer block
+            block_elem, pending_titles = open_blocks.pop()
+            if len(open_blocks):
+                open_blocks[-1][1] += pending_titles
+
+    return category_tables
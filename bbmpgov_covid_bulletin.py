@@ -0,0 +1,512 @@
+import os
+import time
+import hashlib
+import datetime
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lxml import etree
+import requests
+
+from bbmpgov_http_fetch import FetchError
+from bbmpgov_bulletin_manifest import DownloadManifest
+from bbmpgov_chbms_table_extractor import element_text, has_class
+
+
+# URL to fetch from
+bbmp_covid_bulletin_url = 'https://bbmp.gov.in/covid-master/covid19/bulletine.html'
+base_data_link = 'https://bbmp.gov.in/covid-master/covid19/'
+saved_file_basename = 'Covid_Bengaluru'
+
+connect_timeout_sec = 10
+read_timeout_sec = 60
+file_check_retry_time_sec = 60 * 60
+file_download_retry_time_sec = 5 * 60
+routine_check_time_th_sec = 60 * 60
+
+# Within the usual upload window the page is checked more often. The window is
+# learnt from the times bulletins were downloaded on their own date
+upload_window_check_time_sec = 5 * 60
+upload_window_margin_sec = 30 * 60
+upload_window_num_days = 30
+upload_window_min_days = 3
+
+# Bulletins are streamed to disk in chunks by a few concurrent workers
+download_chunk_size = 64 * 1024
+num_download_workers = 4
+file_download_max_retries = 3
+
+# Truncated and mismatched files are moved here
+quarantine_dirname = 'quarantine'
+
+# Tags to look for in the html file
+search_tags = [['div', 'set'], ['table'], ['Date'], ['tr'], ['td']]
+
+
+def read_part_file(part_filepath):
+
+    # Size and running hash of a partly downloaded file
+    sha1 = hashlib.sha1()
+    if not os.path.exists(part_filepath):
+        return 0, sha1
+
+    num_bytes = 0
+    with open(part_filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b''):
+            sha1.update(chunk)
+            num_bytes += len(chunk)
+
+    return num_bytes, sha1
+
+def content_range(r):
+
+    # (first byte, total size) from the Content-Range header, either may be None
+    unit_range = r.headers.get('Content-Range', '').replace('bytes', '').strip()
+    byte_range, _, total_size = unit_range.partition('/')
+    first_byte = byte_range.partition('-')[0]
+
+    return (int(first_byte) if first_byte.isdigit() else None,
+            int(total_size) if total_size.isdigit() else None)
+
+def quarantine_file(filepath, reason):
+
+    # Keeps bad files aside instead of deleting them
+    quarantine_dir = os.path.join(os.path.dirname(filepath), quarantine_dirname)
+    os.makedirs(quarantine_dir, exist_ok=True)
+
+    quarantine_filepath = os.path.join(quarantine_dir, '%s.%d' % (os.path.basename(filepath), int(time.time())))
+    os.replace(filepath, quarantine_filepath)
+    print('Moved %s to %s (%s)' % (filepath, quarantine_filepath, reason))
+
+    return quarantine_filepath
+
+def download_file(fetch_client, data_link, dst_filepath, expected_hash=None, max_retries=file_download_max_retries):
+
+    # Streams the file to a .part file next to dst_filepath and renames it once
+    # complete, so a partial file never shows up under the final name. An
+    # interrupted download, even one from an earlier run, is resumed from the
+    # end of the .part file with a Range request. The length is checked
+    # against the size sent by the server and a resumed file against the hash
+    # in the manifest. Returns the size, the hash and the ETag of the file
+    part_filepath = dst_filepath + '.part'
+    etag = None
+
+    retry_count = 0
+    while 1:
+
+        offset, sha1 = read_part_file(part_filepath)
+        resumed = offset > 0
+
+        # Byte ranges are only meaningful on the unencoded file
+        headers = {'Accept-Encoding': 'identity'}
+        if resumed:
+            headers['Range'] = 'bytes=%d-' % (offset)
+            if etag is not None:
+                # The whole file is sent again if it changed meanwhile
+                headers['If-Range'] = etag
+
+        # Connection errors before the response are retried inside the client
+        r = fetch_client.get(data_link, headers=headers, stream=True)
+
+        try:
+            if r.status_code == 416:
+                # Nothing left to send, the .part file may already be complete
+                total_size = content_range(r)[1]
+                if total_size is None or total_size != offset:
+                    quarantine_file(part_filepath, 'range not satisfiable')
+                    raise FetchError('Unable to resume %s at byte %d' % (data_link, offset))
+
+            else:
+                r.raise_for_status()
+                etag = r.headers.get('ETag', etag)
+
+                if r.status_code == 206 and content_range(r)[0] == offset:
+                    total_size = content_range(r)[1]
+                    file_mode = 'ab'
+                else:
+                    # The server sent the whole file
+                    content_length = r.headers.get('Content-Length', '')
+                    total_size = int(content_length) if content_length.isdigit() else None
+                    offset, sha1 = 0, hashlib.sha1()
+                    resumed = False
+                    file_mode = 'wb'
+
+                with open(part_filepath, file_mode) as f:
+                    for chunk in r.iter_content(chunk_size=download_chunk_size):
+                        f.write(chunk)
+                        sha1.update(chunk)
+                        offset += len(chunk)
+
+            content_hash = sha1.hexdigest()
+
+            if total_size is not None and offset > total_size:
+                quarantine_file(part_filepath, '%d bytes, expected %d' % (offset, total_size))
+                raise FetchError('Unable to download %s: more data than expected' % (data_link))
+
+            if total_size is not None and offset < total_size:
+                # The connection was closed early, resume from where it stopped
+                err_str = 'truncated at %d of %d bytes' % (offset, total_size)
+
+            elif resumed and expected_hash is not None and content_hash != expected_hash:
+                # The pieces may come from different versions of the file
+                quarantine_file(part_filepath, 'hash mismatch after resuming')
+                err_str = 'hash mismatch'
+
+            else:
+                if expected_hash is not None and content_hash != expected_hash:
+                    print('%s changed since it was last downloaded' % (data_link))
+
+                os.replace(part_filepath, dst_filepath)
+                return offset, content_hash, etag
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as err:
+            # The connection dropped while streaming the body, the .part file is kept
+            err_str = type(err).__name__
+
+        finally:
+            r.close()
+
+        if retry_count >= max_retries:
+            raise FetchError('Unable to download %s after %d retries: %s' % (data_link, retry_count, err_str))
+
+        wait_time_sec = fetch_client.backoff_time_sec(retry_count)
+        retry_count += 1
+
+        print('Download of %s interrupted (%s). Resuming in %.1f secs...' % (data_link, err_str, wait_time_sec))
+        time.sleep(wait_time_sec)
+
+def download_files(fetch_client, file_infos, save_dir, manifest, num_workers=num_download_workers):
+
+    # Downloads [filename, data_link, date, filename tag, file ID, expected
+    # hash] entries concurrently and records them in the manifest, returns the
+    # latest date downloaded and the number of files that failed
+    latest_downloaded_date = 0
+    total_bytes = 0
+    num_files = 0
+    num_failed = 0
+
+    start_time_sec = time.time()
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+
+        futures = {}
+        for file_info in file_infos:
+            filename, data_link = file_info[:2]
+            future = executor.submit(download_file, fetch_client, data_link, os.path.join(save_dir, filename), file_info[5])
+            futures[future] = file_info
+
+        for future in as_completed(futures):
+
+            filename, data_link, date_yyyymmdd_int, filename_tag, file_id_str = futures[future][:5]
+            try:
+                num_bytes, content_hash, etag = future.result()
+            except FetchError as err:
+                print(err)
+                num_failed += 1
+                continue
+            except Exception as err:
+                # HTTP errors, and anything else going wrong with this file,
+                # must not lose the files downloaded by the other workers
+                print('Unable to download %s: %s' % (filename, err))
+                num_failed += 1
+                continue
+
+            print('Saved %s to %s' % (filename, save_dir))
+            manifest.add(date_yyyymmdd_int, filename_tag, file_id_str, filename, data_link, num_bytes, content_hash, etag)
+
+            total_bytes += num_bytes
+            num_files += 1
+            if date_yyyymmdd_int > latest_downloaded_date:
+                latest_downloaded_date = date_yyyymmdd_int
+
+    if num_files:
+        elapsed_time_sec = max(time.time() - start_time_sec, 1e-3)
+        print('Downloaded %d files (%.1f MB) in %.1f secs, %.2f MB/s' % (num_files, total_bytes / 1e6, elapsed_time_sec,
+                                                                         total_bytes / 1e6 / elapsed_time_sec))
+
+    return latest_downloaded_date, num_failed
+
+def iter_bulletin_rows(html_text, search_tags, hyperlink_tag):
+
+    # Yields [filename tag, file ID, date (DD-MM-YYYY), hyperlink] for every
+    # bulletin row in document order, parsing the page only as far as the
+    # caller reads
+    if isinstance(html_text, str):
+        html_text = html_text.encode('utf-8')
+
+    block_tag, block_class = search_tags[0]
+    table_tag = search_tags[1][0]
+    date_col_title = search_tags[2][0]
+    row_tag = search_tags[3][0]
+    cell_tag = search_tags[4][0]
+
+    block_depth = 0
+    date_idx = -1
+    hl_idx = -1
+    filename_tag = ''
+
+    events = etree.iterparse(BytesIO(html_text), events=('start', 'end'), html=True, recover=True)
+    for event, elem in events:
+
+        tag = elem.tag
+        if not isinstance(tag, str):
+            continue
+
+        if tag == block_tag and has_class(elem, block_class):
+            block_depth += 1 if event == 'start' else -1
+            continue
+
+        if event == 'start' or block_depth == 0:
+            continue
+
+        if tag == table_tag:
+            elem.clear()
+            continue
+
+        if tag != row_tag:
+            continue
+
+        cells = [child for child in elem if child.tag == cell_tag]
+        if len(cells) == 0:
+
+            # This is the header
+            header_titles = [element_text(child) for child in elem if child.tag == 'th']
+            filename_tag = header_titles[0].replace(' ', '') if len(header_titles) else ''
+
+            date_idx = header_titles.index(date_col_title) if date_col_title in header_titles else -1
+
+            hl_idx = -1
+            for c_idx, col_name in enumerate(header_titles):
+                if hyperlink_tag in col_name:
+                    hl_idx = c_idx
+                    break
+
+            if hl_idx == -1:
+                print('Unable to find the hyperlink tag')
+
+        elif date_idx != -1 and hl_idx != -1 and len(cells) > max(date_idx, hl_idx):
+
+            hyperlink = cells[hl_idx].find('.//a')
+            if hyperlink is not None and hyperlink.get('href'):
+                yield [filename_tag, element_text(cells[0]), element_text(cells[date_idx]), hyperlink.get('href')]
+
+        elem.clear()
+
+def save_daily_statistics_files(fetch_client, html_text, search_tags, hyperlink_tag, from_yyyymmdd, save_dir, manifest,
+                                num_workers=num_download_workers, stop_at_seen=True):
+
+    # Bulletins are listed newest first, so the page is read only up to the
+    # first row older than from_yyyymmdd or, with stop_at_seen, the first row
+    # already in the manifest. Returns the latest date downloaded and the
+    # number of files that failed
+    latest_downloaded_date = 0
+
+    file_infos = []
+
+    for filename_tag, file_id_str, date_str, hl_str in iter_bulletin_rows(html_text, search_tags, hyperlink_tag):
+
+        date_strs = date_str.split('-')
+        date_yyyymmdd_str = ''.join(date_strs[::-1])
+        date_yyyymmdd_int = int(date_yyyymmdd_str)
+        if date_yyyymmdd_int < from_yyyymmdd:
+            latest_downloaded_date = max(latest_downloaded_date, date_yyyymmdd_int)
+            break
+
+        # Files already in the manifest are not fetched again
+        if manifest.contains(date_yyyymmdd_int, filename_tag, file_id_str):
+            latest_downloaded_date = max(latest_downloaded_date, date_yyyymmdd_int)
+            if stop_at_seen:
+                break
+            continue
+
+        filename = '%s_%s_%s_%s.pdf' % (saved_file_basename, date_yyyymmdd_str, filename_tag, file_id_str)
+        dst_filepath = os.path.join(save_dir, filename)
+
+        # A file the manifest does not vouch for, e.g. a truncated one, or
+        # one saved before there was a manifest
+        entry = manifest.get(date_yyyymmdd_int, filename_tag, file_id_str)
+        if os.path.exists(dst_filepath):
+            if entry is None:
+                quarantine_file(dst_filepath, 'no manifest entry')
+            else:
+                quarantine_file(dst_filepath, 'size does not match the manifest')
+
+        # A file downloaded before should come back the same
+        expected_hash = None
+        if entry is not None:
+            expected_hash = entry['sha1']
+
+        data_link = os.path.join(base_data_link, hl_str)
+
+        file_infos.append([filename, data_link, date_yyyymmdd_int, filename_tag, file_id_str, expected_hash])
+
+    # The files are only downloaded once the page is walked
+    files_downloaded_date, num_failed = download_files(fetch_client, file_infos, save_dir, manifest, num_workers)
+    latest_downloaded_date = max(latest_downloaded_date, files_downloaded_date)
+
+    return latest_downloaded_date, num_failed
+
+def find_latest_dl_date(manifest):
+
+    # None if nothing was downloaded yet
+    if manifest.latest_date == 0:
+        return None
+
+    latest_date = str(manifest.latest_date)
+
+    year = int(latest_date[:4])
+    month = int(latest_date[4:6])
+    day = int(latest_date[6:])
+    
+    last_dl_date = datetime.datetime(year,month,day,0,0,0)
+
+    return last_dl_date
+
+def find_from_yyyymmdd(from_date, manifest):
+
+    # Convert from_date tag to actual
+    if from_date == 'all':
+        from_yyyymmdd = 0
+    elif from_date == 'today':
+        from_yyyymmdd = int(datetime.datetime.today().strftime('%Y%m%d'))
+    elif from_date == 'pending':
+        # Check the manifest for the latest downloaded date
+        latest_dl_date = find_latest_dl_date(manifest)
+        if latest_dl_date is None:
+            from_yyyymmdd = 0
+        else:
+            # And start from the next day
+            nextday = latest_dl_date + datetime.timedelta(days=1)
+            from_yyyymmdd = int(nextday.strftime('%Y%m%d'))
+    else:
+        from_yyyymmdd = int(from_date)
+
+    return from_yyyymmdd
+
+def time_to_next_day_sec():
+
+    now = datetime.datetime.now()
+    next_day = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+
+    return int((next_day - now).total_seconds()) + 1
+
+def find_upload_window(manifest, num_days=upload_window_num_days):
+
+    # (start, end) in seconds since midnight of when the bulletins of the last
+    # num_days dates showed up, None if too few were caught on their own date
+    first_dl_secs = {}
+    for entry in manifest.entries.values():
+
+        dl_time = datetime.datetime.fromtimestamp(entry['download_time'])
+        if int(dl_time.strftime('%Y%m%d')) != entry['date']:
+            # Backfilled, says nothing about when it was uploaded
+            continue
+
+        dl_secs = dl_time.hour * 3600 + dl_time.minute * 60 + dl_time.second
+        if dl_secs < first_dl_secs.get(entry['date'], 24 * 3600):
+            first_dl_secs[entry['date']] = dl_secs
+
+    recent_dates = sorted(first_dl_secs)[-num_days:]
+    if len(recent_dates) < upload_window_min_days:
+        return None
+
+    # Leave out the odd early or late day
+    dl_secs = sorted(first_dl_secs[date] for date in recent_dates)
+    start_sec = dl_secs[len(dl_secs) // 10]
+    end_sec = dl_secs[-1 - len(dl_secs) // 10]
+
+    return max(0, start_sec - upload_window_margin_sec), min(24 * 3600, end_sec + upload_window_margin_sec)
+
+def time_to_next_check_sec(upload_window, next_day):
+
+    # Polls often inside the upload window and rarely outside it, never
+    # sleeping past the start of the window
+    if upload_window is None:
+        return time_to_next_day_sec() if next_day else file_check_retry_time_sec
+
+    start_sec, end_sec = upload_window
+
+    now = datetime.datetime.now()
+    now_sec = now.hour * 3600 + now.minute * 60 + now.second
+
+    if next_day:
+        return time_to_next_day_sec() + start_sec
+    if start_sec <= now_sec < end_sec:
+        return upload_window_check_time_sec
+    if now_sec < start_sec:
+        return min(file_check_retry_time_sec, start_sec - now_sec)
+
+    # Later than usual
+    return file_check_retry_time_sec
+
+
+class BulletinWatcher:
+
+    # Downloads the bulletins listed on the bulletin page from from_date on and
+    # works out when the page should be checked next
+
+    def __init__(self, hyperlink_tag, from_date, save_dir, num_workers=num_download_workers):
+
+        self.hyperlink_tag = hyperlink_tag
+        self.from_date = from_date
+        self.save_dir = save_dir
+        self.num_workers = num_workers
+
+        # Create directories if they do not exist
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        # Bulletins downloaded before the manifest existed are added once
+        self.manifest = DownloadManifest(save_dir)
+        if len(self.manifest.entries) == 0:
+            self.manifest.import_existing(saved_file_basename)
+
+        self.from_yyyymmdd = find_from_yyyymmdd(from_date, self.manifest)
+
+        # Page of the last check if some of its files failed to download. The
+        # page may never change again, so they are retried from this copy
+        self.failed_html_text = None
+
+    def update(self, fetch_client, html_text):
+
+        # Returns the time to wait before the next check, None when done. An
+        # html_text of None means the page has not changed since the last check
+        if html_text is None and self.failed_html_text is not None:
+            print('Bulletin page unchanged, retrying the failed downloads...')
+            html_text = self.failed_html_text
+
+        if html_text is None:
+            if self.from_date != 'today':
+                return None
+
+            print('Bulletin page unchanged, waiting for file to get uploaded...')
+            return time_to_next_check_sec(find_upload_window(self.manifest), False)
+
+        # Download the files. A full walk of the archive still looks past the
+        # files it already has, for ones that failed earlier
+        stop_at_seen = self.from_date in ('today', 'pending')
+        latest_dl_date, num_failed = save_daily_statistics_files(fetch_client, html_text, search_tags, self.hyperlink_tag, self.from_yyyymmdd,
+                                                                 self.save_dir, self.manifest, self.num_workers, stop_at_seen)
+        self.failed_html_text = html_text if num_failed else None
+
+        # Next Steps
+        if self.from_date != 'today':
+            return None
+
+        date_today = int(datetime.datetime.today().strftime('%Y%m%d'))
+        if date_today == latest_dl_date:
+
+            # File already downloaded, wait for the next day
+            print('Waiting for next day\'s data...')
+            wait_time_sec = time_to_next_check_sec(find_upload_window(self.manifest), True)
+
+            # Next check starts from the next day
+            next_day = datetime.datetime.today() + datetime.timedelta(days=1)
+            self.from_yyyymmdd = int(next_day.strftime('%Y%m%d'))
+
+            return wait_time_sec
+
+        # Wait for sometime and retry
+        print('Waiting for file to get uploaded...')
+        return time_to_next_check_sec(find_upload_window(self.manifest), False)
@@ -6,22 +6,11 @@ import ast
 import copy
 import argparse
 import random
-import glob
-
-from tqdm import tqdm
-
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
 
 # For fetching data
-import urllib.request
-
-from bs4 import BeautifulSoup
-import pandas as pd
-
-# For sending sms
-import requests
-from requests.exceptions import RequestException
+from bbmpgov_http_fetch import FetchClient, ConditionalFetcher, FetchError
+from bbmpgov_covid_bulletin import (BulletinWatcher, bbmp_covid_bulletin_url, connect_timeout_sec, read_timeout_sec,
+                                    file_download_retry_time_sec)
 
 
 # Added to resolve SSL errors
@@ -45,249 +34,44 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--tags', type=str, help='the hyperlink tag to look for', default='View')
 parser.add_argument('--from_date', type=str, help='date to download from in YYYYMMDD format', default='today')
 parser.add_argument('--save_dir', type=str, help='where to save the downloaded files', default='./')
+parser.add_argument('--num_workers', type=int, help='number of files to download at once', default=4)
 
 args = parser.parse_args()
 
 
-# URL to fetch from
-bbmp_covid_bulletin_url = 'https://bbmp.gov.in/covid-master/covid19/bulletine.html'
-base_data_link = 'https://bbmp.gov.in/covid-master/covid19/'
-saved_file_basename = 'Covid_Bengaluru'
-
-retry_wait_time_sec = 5
-file_check_retry_time_sec = 60 * 60
-file_download_retry_time_sec = 5 * 60
-routine_check_time_th_sec = 60 * 60
-
-def save_daily_statistics_files(soup, search_tags, hyperlink_tag, from_yyyymmdd, save_dir):
-    
-    end_file_download = False
-
-    latest_downloaded_date = 0
-
-    table_infos = []
-
-    tag0_infos = soup.find_all(search_tags[0][0], {'class': search_tags[0][1]})
-    for tag0_info in tag0_infos:
-        
-        tag1_infos = tag0_info.find_all(search_tags[1][0])
-
-        for tag1_info in tag1_infos:
-
-            tag1_vals = pd.read_html(str(tag1_info))[0]
-
-            num_columns = len(tag1_vals.columns)
-            tag1_cols = list(tag1_vals.columns)
-
-            date_idx = tag1_cols.index(search_tags[2][0])
-
-            hl_idx = -1
-            for c_idx,col_name in enumerate(tag1_cols):
-                if hyperlink_tag in col_name:
-                    hl_idx = c_idx
-                    break
-
-            if hl_idx == -1:
-                print('Unable to find the hyperlink tag')
-
-            tag3_infos = tag1_info.find_all(search_tags[3][0])
-            num_infos = len(tag3_infos)
-
-            filename_tag = ''
-            for tag3_info in tag3_infos:
-
-                tag4_infos = tag3_info.find_all(search_tags[4][0])
-                if len(tag4_infos) == 0:
-                    # This is the header
-                    tagh_infos = tag3_info.find_all('th')
-                    filename_tag = tagh_infos[0].contents[0].replace(' ', '')
-                    continue
-
-                date_strs = tag4_infos[date_idx].contents[0].split('-')
-                date_yyyymmdd_str = ''.join(date_strs[::-1])
-                date_yyyymmdd_int = int(date_yyyymmdd_str)
-                if date_yyyymmdd_int < from_yyyymmdd:
-                    latest_downloaded_date = date_yyyymmdd_int
-                    end_file_download = True
-                    break
-
-                file_id_str = tag4_infos[0].contents[0]
-
-                hl_str = tag4_infos[hl_idx].contents[0].attrs['href']
-                
-                filename = '%s_%s_%s_%s.pdf' % (saved_file_basename, date_yyyymmdd_str, filename_tag, file_id_str)
-                dst_filepath = os.path.join(save_dir, filename)
-
-                data_link = os.path.join(base_data_link, hl_str)
-
-                retry_count = 0
-                while 1:
-
-                    try:
-
-                        r = requests.get(data_link, allow_redirects=True)
-                        r.raise_for_status()
-
-                        open(dst_filepath, 'wb').write(r.content)
-                        print('Saved %s to %s' % (filename, save_dir))
-
-                        if date_yyyymmdd_int > latest_downloaded_date:
-                            latest_downloaded_date = date_yyyymmdd_int
-
-                        break
-
-                    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-
-                        if retry_count > 5:
-                            break
-                        retry_count += 1
-
-                        print('Internet Connection Error. Will try after sometime')
-                        for t_idx in tqdm(range(file_download_retry_time_sec)):
-                            time.sleep(1)
-
-                    except requests.exceptions.TooManyRedirects:
-                        break
-                    except requests.exceptions.RequestException as e:
-                        break
-                    except requests.exceptions.HTTPError as err:
-                        break
-                
-
-            if end_file_download:
-                break
-
-        if end_file_download:
-            break
-
-    return latest_downloaded_date
-
-def find_latest_dl_date(save_dir):
-
-    latest_date = 0
-
-    filepaths = glob.glob(save_dir + '/*.pdf')
-
-    for filepath in filepaths:
-
-        filename = os.basename(filepath)
-        filedate = int(filename.split('_')[2])
-
-        if filedate > latest_date:
-            latest_date = filedate
-
-    latest_date = str(latest_date)
-
-    year = int(latest_date[:4])
-    month = int(latest_date[4:6])
-    day = int(latest_date[6:])
-    
-    last_dl_date = datetime.datetime(year,month,day,0,0,0)
-
-    return last_dl_date
-
-def url_connect(url, retry_wait_time_sec=5):
-
-    conn_status = True
-
-    while 1:
-
-        try:
-            # open a connection to a URL using urllib
-            webUrl  = urllib.request.urlopen(url)
-            ret_code = webUrl.getcode()
-            if ret_code == 200:
-                if conn_status is False:
-                    print('Connection Restored')
-                conn_status = True
-                break
-            else:
-                conn_status = False
-                print('Looks like there was an error in getting the data. Retrying...')
-                for t_idx in tqdm(range(retry_wait_time_sec)):
-                    time.sleep(1)
-        except:
-            conn_status = False
-            print('Looks like there is connection issue. Retrying...')
-            for t_idx in tqdm(range(retry_wait_time_sec)):
-                time.sleep(1)
-    
-    return webUrl
-
 if __name__ == "__main__":
 
     hyperlink_tags = list(args.tags.split(','))
-    from_date = args.from_date
-    save_dir = args.save_dir
 
     # Only one tag for now
     hyperlink_tag = hyperlink_tags[0]
 
-    # Convert from_date tag to actual
-    if from_date == 'all':
-        from_yyyymmdd = 0
-    elif from_date == 'today':
-        from_yyyymmdd = int(datetime.today().strftime('%Y%m%d'))
-    elif from_date == 'pending':
-        # Check the directory for the latest downloaded date
-        latest_dl_date = find_latest_dl_date(save_dir)
-        # And start from the next day
-        nextday = latest_dl_date + datetime.timedelta(days=1)
-        from_yyyymmdd = int(nextday.strftime('%Y%m%d'))
-    else:
-        from_yyyymmdd = int(from_date)
-
-    # Create directories if they do not exist
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    bulletin_watcher = BulletinWatcher(hyperlink_tag, args.from_date, args.save_dir, args.num_workers)
 
-    while 1:
-
-        # Fetch the data from the url
-        webUrl = url_connect(bbmp_covid_bulletin_url, retry_wait_time_sec)
+    # Keep-alive connections shared by the bulletin page and the file downloads
+    fetch_client = FetchClient(connect_timeout_sec, read_timeout_sec, backoff_max_sec=file_download_retry_time_sec,
+                               pool_maxsize=args.num_workers)
 
-        # read the data from the URL and print it
-        html_text = webUrl.read()
+    # An unchanged bulletin page only costs a 304
+    page_fetcher = ConditionalFetcher(bbmp_covid_bulletin_url, fetch_client)
 
-        # Get html formatted output
-        soup = BeautifulSoup(html_text, 'html.parser')
-
-        # Tags to look for in the html file
-        search_tags = [['div', 'set'], ['table'], ['Date'], ['tr'], ['td']]
+    while 1:
 
-        # Download the files
-        latest_dl_date = save_daily_statistics_files(soup, search_tags, hyperlink_tag, from_yyyymmdd, save_dir)
+        # Intervals are measured from the start of each check
+        check_time = time.monotonic()
 
-        # Next Steps
-        if from_date in ['all','pending']:
+        # Fetch the data from the url, connection errors are retried until it is in
+        try:
+            html_text = page_fetcher.fetch(max_retries=None)
+        except FetchError as err:
+            print('Looks like there was an error (%s) in getting the data. Retrying...' % (err))
+            time.sleep(fetch_client.backoff_time_sec(5))
+            continue
+
+        # Download the files and find when to check next
+        wait_time_sec = bulletin_watcher.update(fetch_client, html_text)
+        if wait_time_sec is None:
             break
-        elif from_date == 'today':
-
-            date_today = int(datetime.today().strftime('%Y%m%d'))
-            if date_today == latest_dl_date:
-
-                # File already downloaded, wait for the next day
-                time_now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                time_nextday = (datetime.today() + datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
-
-                # Calculate difference:
-                start = datetime.strptime(time_now,'%Y-%m-%d %H:%M:%S')
-                ends = datetime.strptime(time_nextday, '%Y-%m-%d %H:%M:%S')
-                diff = relativedelta(ends, start)
-
-                rem_time_secs = (diff.days*24*60*60) + ((diff.hours+1)*60*60) + (diff.minutes*60) + diff.seconds
-
-                # Sleeep for the remaining time
-                print('Waiting for next day\'s data...')
-                for t_idx in tqdm(range(rem_time_secs)):
-                    time.sleep(1)
-
-                # Set the new value and continue
-                from_yyyymmdd = int(datetime.today().strftime('%Y%m%d'))
-
-            else:
 
-                # Wait for sometime and retry
-                print('Waiting for file to get uploaded...')
-                for t_idx in tqdm(range(file_check_retry_time_sec)):
-                    time.sleep(1)
\ No newline at end of file
+        print('Next check in %d secs' % (wait_time_sec))
+        time.sleep(max(0, check_time + wait_time_sec - time.monotonic()))
@@ -0,0 +1,145 @@
+import re
+
+import numpy as np
+
+from bbmpgov_chbms_snapshot import HospitalNames
+
+
+# Names are compared without case, punctuation and common abbreviations
+non_word_re = re.compile(r'[^\w]+')
+digits_re = re.compile(r'\d+')
+
+name_abbreviations = {
+    'hosp': 'hospital',
+    'hospl': 'hospital',
+    'hsptl': 'hospital',
+    'govt': 'government',
+    'gov': 'government',
+    'pvt': 'private',
+    'ltd': 'limited',
+    'st': 'saint',
+    'med': 'medical',
+    'coll': 'college',
+    'clg': 'college',
+    'inst': 'institute',
+    'res': 'research',
+    'ctr': 'centre',
+    'cntr': 'centre',
+    'center': 'centre',
+    'spl': 'speciality',
+    'specialty': 'speciality',
+    'multispeciality': 'multi speciality',
+    'multispecialty': 'multi speciality',
+    'n': 'and',
+    }
+
+
+def normalise_hospital_name(name):
+
+    # Apostrophes are dropped so that St. John's and St Johns read the same
+    name = name.replace("'", '').replace('\u2019', '').replace('&', ' and ')
+
+    words = non_word_re.sub(' ', name.lower()).split()
+    return ' '.join(name_abbreviations.get(word, word) for word in words)
+
+def digits_signature(key):
+
+    # Names with different numbers, or the same numbers in another order,
+    # are never merged: 'Hospital 1-10' is neither 'Hospital 10-1' nor
+    # 'Hospital 11-0'
+    return tuple(digits_re.findall(key))
+
+def word_signature(key):
+
+    # Same words in another order, 'Apollo Hospital Jayanagar' and
+    # 'Jayanagar Apollo Hospital'
+    return (tuple(sorted(key.split())), digits_signature(key))
+
+def joined_signature(key):
+
+    # Same letters split into words differently, 'Jaya Nagar' and 'Jayanagar'
+    return (key.replace(' ', ''), digits_signature(key))
+
+
+class HospitalRegistry(HospitalNames):
+
+    # HospitalNames that gives every hospital one ID whatever its spelling.
+    # A spelling is looked up as is, then by its normalised name, then by a
+    # known name with the same words in another order or split differently.
+    # Names differing in any letter are never merged, 'Sri Sai Hospital' and
+    # 'Sri Sri Hospital' are two hospitals. Every spelling is resolved only
+    # once, after that it is a dict lookup. The first spelling seen is the
+    # one displayed
+
+    __slots__ = ('key_ids', 'word_ids', 'joined_ids', 'fuzzy_names', 'fuzzy_match')
+
+    def __init__(self, fuzzy_match=True):
+
+        super().__init__()
+
+        self.key_ids = {}
+        self.word_ids = {}
+        self.joined_ids = {}
+        self.fuzzy_match = fuzzy_match
+
+        # Spellings resolved by their word or joined signature
+        self.fuzzy_names = set()
+
+    def fuzzy_find(self, key, exclude_ids):
+
+        for name_id in (self.word_ids.get(word_signature(key)), self.joined_ids.get(joined_signature(key))):
+            if name_id is not None and name_id not in exclude_ids:
+                return name_id
+
+        return None
+
+    def find(self, name, exclude_ids=frozenset()):
+
+        # ID of a known hospital, None for a new one. A spelling is never
+        # matched by signature to exclude_ids, the hospitals already in the
+        # same table: two spellings side by side are two hospitals
+        name_id = self.name_ids.get(name)
+        if name_id is not None and (name_id not in exclude_ids or name not in self.fuzzy_names):
+            return name_id
+
+        key = normalise_hospital_name(name)
+        name_id = self.key_ids.get(key)
+        if name_id is not None:
+            self.name_ids[name] = name_id
+            return name_id
+
+        if self.fuzzy_match:
+            name_id = self.fuzzy_find(key, exclude_ids)
+            if name_id is not None:
+                self.name_ids[name] = name_id
+                self.fuzzy_names.add(name)
+
+        return name_id
+
+    def intern(self, name, exclude_ids=frozenset()):
+
+        name_id = self.find(name, exclude_ids)
+        if name_id is None:
+
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.fuzzy_names.discard(name)
+            self.names.append(name)
+
+            key = normalise_hospital_name(name)
+            self.key_ids[key] = name_id
+            self.word_ids.setdefault(word_signature(key), name_id)
+            self.joined_ids.setdefault(joined_signature(key), name_id)
+
+        return name_id
+
+    def intern_all(self, names):
+
+        # names are the rows of one table
+        table_ids = set()
+        name_ids = np.empty(len(names), dtype=np.int32)
+        for n_idx, name in enumerate(names):
+            name_ids[n_idx] = self.intern(name, table_ids)
+            table_ids.add(name_ids[n_idx])
+
+        return name_ids
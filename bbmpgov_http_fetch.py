@@ -0,0 +1,141 @@
+import time
+import random
+import hashlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Status codes worth retrying, everything else is returned to the caller
+retry_status_codes = [429, 500, 502, 503, 504]
+
+
+class FetchError(Exception):
+    pass
+
+
+def backoff_time_sec(retry_count, backoff_base_sec, backoff_max_sec):
+
+    # Full jitter keeps several clients from retrying in lock step
+    max_wait_time_sec = min(backoff_max_sec, backoff_base_sec * (2 ** retry_count))
+    return random.uniform(0, max_wait_time_sec)
+
+
+class FetchClient:
+
+    # One keep-alive connection pool shared by every fetch, with timeouts and
+    # jittered exponential backoff between retries
+
+    def __init__(self, connect_timeout_sec=5, read_timeout_sec=30, max_retries=5,
+                 backoff_base_sec=1, backoff_max_sec=5*60, pool_maxsize=4):
+
+        self.timeout = (connect_timeout_sec, read_timeout_sec)
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+
+        # Retries are handled here, so the adapter should not retry on its own
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize, max_retries=0)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def backoff_time_sec(self, retry_count):
+        return backoff_time_sec(retry_count, self.backoff_base_sec, self.backoff_max_sec)
+
+    def get(self, url, headers=None, stream=False, max_retries=-1):
+
+        # max_retries of None retries forever, -1 uses the client default
+        if max_retries == -1:
+            max_retries = self.max_retries
+
+        retry_count = 0
+        while 1:
+
+            try:
+                response = self.session.get(url, headers=headers, stream=stream,
+                                            timeout=self.timeout, allow_redirects=True)
+                if response.status_code not in retry_status_codes:
+                    return response
+
+                err_str = 'HTTP %d' % (response.status_code)
+                response.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                err_str = type(err).__name__
+            except requests.exceptions.RequestException as err:
+                raise FetchError('Unable to fetch %s: %s' % (url, err)) from err
+
+            if max_retries is not None and retry_count >= max_retries:
+                raise FetchError('Unable to fetch %s after %d retries: %s' % (url, retry_count, err_str))
+
+            wait_time_sec = self.backoff_time_sec(retry_count)
+            retry_count += 1
+
+            print('Looks like there is connection issue (%s). Retrying in %.1f secs...' % (err_str, wait_time_sec))
+            time.sleep(wait_time_sec)
+
+    def close(self):
+        self.session.close()
+
+
+class ConditionalFetcher:
+
+    # Fetches a page with conditional GETs (If-None-Match/If-Modified-Since)
+    # and a content hash, so that an unchanged page is reported as None and
+    # the caller can skip parsing it altogether
+
+    def __init__(self, url, fetch_client=None):
+
+        self.url = url
+        self.fetch_client = fetch_client if fetch_client is not None else FetchClient()
+
+        # Validators returned by the server for the last changed page
+        self.etag = None
+        self.last_modified = None
+
+        # Hash of the last changed page body
+        self.content_hash = None
+
+    def build_headers(self):
+
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+    def check_response(self, status_code, headers, html_text):
+
+        # Returns the page body if it changed since the last fetch, else None
+        if status_code == 304:
+            # Not modified since the last fetch
+            return None
+
+        if status_code != 200:
+            raise FetchError('Unable to fetch %s: HTTP %d' % (self.url, status_code))
+
+        # Keep the validators for the next request
+        etag = headers.get('ETag')
+        if etag is not None:
+            self.etag = etag
+        last_modified = headers.get('Last-Modified')
+        if last_modified is not None:
+            self.last_modified = last_modified
+
+        # Servers without validators still send the full page, so compare hashes
+        content_hash = hashlib.sha1(html_text).hexdigest()
+        if content_hash == self.content_hash:
+            return None
+        self.content_hash = content_hash
+
+        return html_text
+
+    def fetch(self, max_retries=-1):
+
+        response = self.fetch_client.get(self.url, headers=self.build_headers(), max_retries=max_retries)
+
+        return self.check_response(response.status_code, response.headers, response.content)
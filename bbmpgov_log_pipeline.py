@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+# Log files are rotated when they reach log_max_bytes or are older than
+# log_rotate_interval_sec, whichever comes first
+log_max_bytes = 50 * 1024 * 1024
+log_rotate_interval_sec = 24 * 60 * 60
+log_backup_count = 7
+
+
+class LazyMessage:
+
+    # Log message built only when a handler writes it, on the listener's
+    # thread. Everything it refers to must not change after it is logged,
+    # which holds for snapshots and change lists
+
+    __slots__ = ('render_func', 'args')
+
+    def __init__(self, render_func, *args):
+        self.render_func = render_func
+        self.args = args
+
+    def __str__(self):
+        return self.render_func(*self.args)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    # QueueHandler formats every message on the logging thread, here that is
+    # left to the listener so the poller only pays for the queue put
+    def prepare(self, record):
+        return record
+
+
+class LogListener(logging.handlers.QueueListener):
+
+    # Stopped at exit, and may have been stopped before that
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class SizeTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+
+    # Rotates on size like RotatingFileHandler, and also once the current
+    # file has been written to for rotate_interval_sec
+
+    def __init__(self, filename, max_bytes=log_max_bytes, rotate_interval_sec=log_rotate_interval_sec,
+                 backup_count=log_backup_count):
+
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+
+        self.rotate_interval_sec = rotate_interval_sec
+        self.rollover_time = time.time() + rotate_interval_sec
+        if os.path.exists(filename):
+            self.rollover_time = os.path.getmtime(filename) + rotate_interval_sec
+
+    def shouldRollover(self, record):
+
+        if self.rotate_interval_sec > 0 and time.time() >= self.rollover_time and os.path.exists(self.baseFilename):
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+
+        super().doRollover()
+        self.rollover_time = time.time() + self.rotate_interval_sec
+
+
+def start_log_pipeline(logger, log_filename, fmt='%(message)s', max_bytes=log_max_bytes,
+                       rotate_interval_sec=log_rotate_interval_sec, backup_count=log_backup_count):
+
+    # Sends the records of logger through a queue to a rotating file written
+    # by a background thread. The queue is flushed at exit
+    file_handler = SizeTimeRotatingFileHandler(log_filename, max_bytes, rotate_interval_sec, backup_count)
+    file_handler.setFormatter(logging.Formatter(fmt))
+
+    log_queue = queue.SimpleQueue()
+    listener = LogListener(log_queue, file_handler)
+
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
+
+def event_logger(name, events_filename):
+
+    # JSON lines stream of snapshots and changes, one event per line
+    logger = logging.getLogger(name)
+    logger.propagate = False
+
+    start_log_pipeline(logger, events_filename)
+
+    return logger
+
+
+def snapshot_event_json(cur_snapshot, hospital_names):
+
+    categories = {}
+    for title, rows in cur_snapshot.tables_rows(hospital_names):
+        categories[title] = rows
+
+    event = {
+        'event': 'snapshot',
+        'time': round(cur_snapshot.timestamp, 3),
+        'bed_types': cur_snapshot.bed_types,
+        'categories': categories,
+        }
+    return json.dumps(event, separators=(',', ':'))
+
+def changes_event_json(cur_snapshot, hosp_categories, bed_availabiliy):
+
+    event = {
+        'event': 'changes',
+        'time': round(cur_snapshot.timestamp, 3),
+        'bed_types': cur_snapshot.bed_types,
+        'categories': dict(zip(hosp_categories, bed_availabiliy)),
+        }
+    return json.dumps(event, separators=(',', ':'))
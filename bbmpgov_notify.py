@@ -0,0 +1,321 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+import requests
+
+from bbmpgov_http_fetch import retry_status_codes, backoff_time_sec
+
+
+# Changes are collected for a while and sent as one digest, and a recipient
+# gets at most one message per interval
+notify_queue_size = 256
+digest_window_sec = 2 * 60
+min_message_interval_sec = 15 * 60
+send_max_retries = 5
+send_backoff_base_sec = 2
+send_backoff_max_sec = 5 * 60
+
+# SMS bodies longer than this are cut short
+max_message_len = 1500
+
+# Twilio account, the destination may be a comma separated list
+twilio_account_sid_env_var = 'TWILIO_AC_SID'
+twilio_auth_token_env_var = 'TWILIO_AUTH_TOKEN'
+twilio_src_num_env_var = 'TWILIO_SRC_PNUM'
+twilio_dst_num_env_var = 'TWILIO_DST_PNUM'
+
+
+class NotifyError(Exception):
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def check_send_response(response, transport_name):
+
+    if response.status_code < 400:
+        return
+
+    # Rejected messages are not sent again
+    retryable = response.status_code in retry_status_codes
+    raise NotifyError('%s returned HTTP %d: %s' % (transport_name, response.status_code, response.text[:200]), retryable)
+
+
+class TwilioTransport:
+
+    # Sends SMS through the Twilio REST API
+
+    def __init__(self, account_sid, auth_token, src_num, timeout=(5, 30)):
+
+        self.sms_url = 'https://api.twilio.com/2010-04-01/Accounts/%s/Messages.json' % (account_sid)
+        self.auth = (account_sid, auth_token)
+        self.src_num = src_num
+        self.timeout = timeout
+
+        self.session = requests.Session()
+
+    def send(self, recipient, body):
+
+        data = {'To': recipient, 'From': self.src_num, 'Body': body}
+        response = self.session.post(self.sms_url, data=data, auth=self.auth, timeout=self.timeout)
+        check_send_response(response, 'Twilio')
+
+
+class HttpTransport:
+
+    # Posts {'to': recipient, 'body': body} as JSON to any endpoint, e.g. a
+    # local stand-in when testing
+
+    def __init__(self, url, timeout=(5, 30)):
+
+        self.url = url
+        self.timeout = timeout
+
+        self.session = requests.Session()
+
+    def send(self, recipient, body):
+
+        response = self.session.post(self.url, json={'to': recipient, 'body': body}, timeout=self.timeout)
+        check_send_response(response, self.url)
+
+
+def merge_changes(pending_changes, hosp_categories, bed_availabiliy):
+
+    # Sums the bed count changes per (category, hospital), so a bed freed and
+    # taken again between two messages cancels out
+    for hosp_category, hosp_beds_info in zip(hosp_categories, bed_availabiliy):
+        for row in hosp_beds_info:
+            key = (hosp_category, row[0])
+            bed_difs = pending_changes.get(key)
+            if bed_difs is None:
+                pending_changes[key] = list(row[1:])
+            else:
+                pending_changes[key] = [total + bed_dif for total, bed_dif in zip(bed_difs, row[1:])]
+
+def format_digest(pending_changes, bed_types, since_time_sec):
+
+    # One line per hospital with a net change, grouped by category. None if
+    # everything cancelled out
+    category_lines = {}
+    for (hosp_category, hospital), bed_difs in pending_changes.items():
+
+        bed_strs = ['%s %+d' % (bed_type, bed_dif) for bed_type, bed_dif in zip(bed_types, bed_difs) if bed_dif != 0]
+        if len(bed_strs) == 0:
+            continue
+
+        category_lines.setdefault(hosp_category, []).append('%s: %s' % (hospital, ', '.join(bed_strs)))
+
+    if len(category_lines) == 0:
+        return None
+
+    since_str = time.strftime('%H:%M', time.localtime(since_time_sec))
+    lines = ['Bed availability changes since %s' % (since_str)]
+    for hosp_category, hospital_lines in category_lines.items():
+        lines.append('')
+        lines.append(hosp_category)
+        lines += hospital_lines
+
+    # Keep within one message, saying how much was left out
+    body = ''
+    for l_idx, line in enumerate(lines):
+        more_str = '\n... %d more' % (len(lines) - l_idx)
+        if len(body) + len(line) + 1 + len(more_str) > max_message_len:
+            body += more_str
+            break
+        body += ('\n' if l_idx else '') + line
+
+    return body
+
+
+class NotificationDispatcher:
+
+    # Sends bed availability changes on a thread of its own, so that a slow
+    # SMS API never delays the poller. Changes wait in a bounded queue, are
+    # merged into a digest per recipient and sent once the digest window has
+    # passed and the recipient's rate limit allows it. A failed send is tried
+    # again after a backoff of its own, so one recipient's failures never hold
+    # up the others
+
+    def __init__(self, transport, recipients, bed_types, digest_window_sec=digest_window_sec,
+                 min_message_interval_sec=min_message_interval_sec, queue_size=notify_queue_size,
+                 max_retries=send_max_retries, backoff_base_sec=send_backoff_base_sec,
+                 backoff_max_sec=send_backoff_max_sec, logger=logging.root):
+
+        self.transport = transport
+        self.recipients = list(recipients)
+        self.bed_types = list(bed_types)
+        self.digest_window_sec = digest_window_sec
+        self.min_message_interval_sec = min_message_interval_sec
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.logger = logger
+
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        # Per recipient: merged changes, when the first of them came in (wall
+        # clock and monotonic), when the next message may go out and how many
+        # sends of the digest failed in a row. Only touched by the dispatcher
+        # thread
+        self.pending_changes = {}
+        self.pending_since = {}
+        self.next_send_times = {}
+        self.failure_counts = {}
+
+        self.thread = threading.Thread(target=self.run, name='notification-dispatcher', daemon=True)
+        self.thread.start()
+
+    def notify(self, hosp_categories, bed_availabiliy):
+
+        # Called by the poller with the changes for every default recipient
+        if len(hosp_categories) == 0:
+            return
+
+        self.notify_recipients({recipient: [hosp_categories, bed_availabiliy] for recipient in self.recipients})
+
+    def notify_recipients(self, recipient_changes):
+
+        # Called by the poller with {recipient: [categories, changes]}, never
+        # blocks
+        if len(recipient_changes) == 0:
+            return
+
+        try:
+            self.queue.put_nowait([time.time(), recipient_changes])
+        except queue.Full:
+            self.logger.warning('Notification queue full, dropping changes for %d recipients' % (len(recipient_changes)))
+
+    def due_time(self, recipient):
+
+        since = self.pending_since.get(recipient)
+        if since is None:
+            return None
+
+        return max(since[1] + self.digest_window_sec, self.next_send_times.get(recipient, 0))
+
+    def send_once(self, recipient, body):
+
+        # Returns [sent, worth sending again later], never sleeps
+        try:
+            self.transport.send(recipient, body)
+            return [True, False]
+        except NotifyError as err:
+            if not err.retryable:
+                self.logger.warning('Dropping the digest for %s: %s' % (recipient, err))
+                return [False, False]
+            err_str = str(err)
+        except requests.exceptions.RequestException as err:
+            err_str = type(err).__name__
+        except Exception:
+            self.logger.exception('Unable to notify %s' % (recipient))
+            return [False, True]
+
+        self.logger.warning('Unable to notify %s: %s' % (recipient, err_str))
+        return [False, True]
+
+    def send_digest(self, recipient):
+
+        # Changes that cancelled out send nothing and leave the rate limit as is
+        body = format_digest(self.pending_changes[recipient], self.bed_types, self.pending_since[recipient][0])
+        sent, retryable = False, False
+        if body is not None:
+            sent, retryable = self.send_once(recipient, body)
+
+        # Digests that failed for now are kept and merged with the next
+        # changes, rejected ones are dropped
+        if not retryable:
+            del self.pending_changes[recipient]
+            del self.pending_since[recipient]
+            self.failure_counts.pop(recipient, None)
+
+        now = time.monotonic()
+        if sent:
+            self.next_send_times[recipient] = now + self.min_message_interval_sec
+
+        elif retryable:
+
+            # Tried again after a growing backoff, then only once per interval
+            failure_count = self.failure_counts.get(recipient, 0)
+            if failure_count < self.max_retries:
+                self.failure_counts[recipient] = failure_count + 1
+                self.next_send_times[recipient] = now + backoff_time_sec(failure_count, self.backoff_base_sec,
+                                                                         self.backoff_max_sec)
+            else:
+                del self.failure_counts[recipient]
+                self.next_send_times[recipient] = now + self.min_message_interval_sec
+
+    def send_due_digest(self, recipient):
+
+        # A digest that cannot even be built is dropped rather than tried in
+        # a tight loop, the dispatcher keeps going either way
+        try:
+            self.send_digest(recipient)
+        except Exception:
+            self.logger.exception('Dropping the digest for %s' % (recipient))
+            self.pending_changes.pop(recipient, None)
+            self.pending_since.pop(recipient, None)
+            self.failure_counts.pop(recipient, None)
+
+    def run(self):
+
+        while 1:
+
+            due_times = [due_time for due_time in map(self.due_time, self.pending_since) if due_time is not None]
+
+            timeout = None
+            if len(due_times):
+                timeout = max(0, min(due_times) - time.monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = []
+
+            if item is None:
+                break
+
+            if len(item):
+                change_time, recipient_changes = item
+                for recipient, (hosp_categories, bed_availabiliy) in recipient_changes.items():
+                    merge_changes(self.pending_changes.setdefault(recipient, {}), hosp_categories, bed_availabiliy)
+                    if self.pending_since.get(recipient) is None:
+                        self.pending_since[recipient] = [change_time, time.monotonic()]
+
+            now = time.monotonic()
+            for recipient in list(self.pending_since):
+                due_time = self.due_time(recipient)
+                if due_time is not None and due_time <= now:
+                    self.send_due_digest(recipient)
+
+        # Whatever is left goes out on the way down
+        for recipient in list(self.pending_since):
+            if self.pending_since.get(recipient) is not None:
+                self.send_due_digest(recipient)
+
+    def close(self, timeout=None):
+
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+def build_notification_dispatcher(bed_types, notify_url='', logger=logging.root, subscribed=False):
+
+    # Posts to notify_url if given, otherwise sends SMS when the Twilio
+    # account is set in the environment. None if neither is available. With
+    # subscribers the destination numbers are optional
+    if notify_url:
+        return NotificationDispatcher(HttpTransport(notify_url), [] if subscribed else ['local'], bed_types, logger=logger)
+
+    account_sid = os.environ.get(twilio_account_sid_env_var)
+    auth_token = os.environ.get(twilio_auth_token_env_var)
+    src_num = os.environ.get(twilio_src_num_env_var)
+    dst_nums = os.environ.get(twilio_dst_num_env_var, '')
+    if not (account_sid and auth_token and src_num and (dst_nums or subscribed)):
+        return None
+
+    transport = TwilioTransport(account_sid, auth_token, src_num)
+    return NotificationDispatcher(transport, [dst_num for dst_num in dst_nums.split(',') if dst_num], bed_types, logger=logger)
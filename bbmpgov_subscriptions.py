@@ -0,0 +1,184 @@
+import json
+import logging
+
+from bbmpgov_hospital_registry import normalise_hospital_name
+
+
+# Subscribers are notified only of the changes they asked for. Every
+# subscription names the categories, hospitals and bed types to watch, any
+# of them left out meaning all, and the number of available beds below
+# which changes are of no interest
+
+default_min_available = 1
+
+
+def read_subscriptions(subscriptions_filename):
+
+    # A JSON list of subscriptions, each with a recipient and optionally
+    # categories, hospitals, bed_types and min_available
+    with open(subscriptions_filename, 'r') as f:
+        subscriptions = json.load(f)
+
+    for subscription in subscriptions:
+        if 'recipient' not in subscription:
+            raise ValueError('Every subscription in %s needs a recipient' % (subscriptions_filename))
+
+    return subscriptions
+
+
+class SubscriptionIndex:
+
+    # Inverted index from (category, hospital ID, bed type) to the
+    # subscriptions interested in it, None standing for any. A change is
+    # matched by looking up the 8 combinations of its keys and their
+    # wildcards, so a poll costs O(changes) however many subscribers there
+    # are. Hospitals are indexed by their registry ID, so every spelling of
+    # a subscribed hospital matches. The registry is only read, never added
+    # to, so subscribers' spellings are never displayed. Hospitals not on the
+    # page yet wait by normalised name until they show up
+
+    def __init__(self, bed_types, hospital_names, logger=logging.root):
+
+        self.bed_types = list(bed_types)
+        self.hospital_names = hospital_names
+        self.logger = logger
+
+        # Per subscription: [recipient, min_available]
+        self.subscriptions = []
+        self.index = {}
+
+        # Normalised name -> [subscription index, categories, bed types] of
+        # the hospitals not known yet, retried whenever new hospitals appear
+        self.pending_hospitals = {}
+        self.num_names_resolved = 0
+
+    def add(self, recipient, categories=None, hospitals=None, bed_types=None, min_available=default_min_available):
+
+        # Bed types not watched can never change
+        if bed_types is not None:
+            unwatched_bed_types = [bed_type for bed_type in bed_types if bed_type not in self.bed_types]
+            if len(unwatched_bed_types):
+                self.logger.warning('Bed types %s of %s are not watched' % (', '.join(unwatched_bed_types), recipient))
+            bed_types = [bed_type for bed_type in bed_types if bed_type in self.bed_types]
+            if len(bed_types) == 0:
+                return
+
+        s_idx = len(self.subscriptions)
+        self.subscriptions.append([recipient, min_available])
+
+        hospital_ids = None
+        if hospitals is not None:
+            hospital_ids = []
+            for hospital in hospitals:
+                hospital_id = self.hospital_names.find(hospital)
+                if hospital_id is None:
+                    self.pending_hospitals.setdefault(normalise_hospital_name(hospital), []).append([s_idx, categories, bed_types])
+                else:
+                    hospital_ids.append(hospital_id)
+
+        self.index_subscription(s_idx, categories, hospital_ids, bed_types)
+
+    def index_subscription(self, s_idx, categories, hospital_ids, bed_types):
+
+        # None stands for any, an empty list of hospitals for none yet
+        for category in categories or [None]:
+            for hospital_id in [None] if hospital_ids is None else hospital_ids:
+                for bed_type in bed_types or [None]:
+                    self.index.setdefault((category, hospital_id, bed_type), []).append(s_idx)
+
+    def resolve_pending_hospitals(self):
+
+        # Only worth trying when the registry has new hospitals
+        num_names = len(self.hospital_names.names)
+        if len(self.pending_hospitals) == 0 or num_names == self.num_names_resolved:
+            return
+        self.num_names_resolved = num_names
+
+        for key, pending_subscriptions in list(self.pending_hospitals.items()):
+
+            hospital_id = self.hospital_names.find(key)
+            if hospital_id is None:
+                continue
+
+            del self.pending_hospitals[key]
+            for s_idx, categories, bed_types in pending_subscriptions:
+                self.index_subscription(s_idx, categories, [hospital_id], bed_types)
+
+    def add_all(self, subscriptions):
+
+        for subscription in subscriptions:
+            self.add(subscription['recipient'], subscription.get('categories'), subscription.get('hospitals'),
+                     subscription.get('bed_types'), subscription.get('min_available', default_min_available))
+
+    def lookup(self, category, hospital_id, bed_type):
+
+        for key_category in (category, None):
+            for key_hospital_id in (hospital_id, None):
+                for key_bed_type in (bed_type, None):
+                    yield from self.index.get((key_category, key_hospital_id, key_bed_type), ())
+
+    def match(self, cur_snapshot, hosp_categories, bed_availabiliy):
+
+        # Splits the changes of a poll by recipient, {recipient: [categories,
+        # changes]} in the format of find_snapshot_changes(). A change
+        # matches a subscription if the beds available before or after it
+        # reach min_available
+        recipient_tables = {}
+        num_bed_types = len(self.bed_types)
+
+        self.resolve_pending_hospitals()
+
+        for hosp_category, hosp_beds_info in zip(hosp_categories, bed_availabiliy):
+
+            # Beds now available per hospital of the changed category, removed
+            # hospitals have none
+            cur_counts = {}
+            category = cur_snapshot.category(hosp_category)
+            if category is not None:
+                ids, counts = category
+                for hospital_id, row_counts in zip(ids.tolist(), counts.tolist()):
+                    prev_counts = cur_counts.get(hospital_id)
+                    if prev_counts is not None:
+                        row_counts = [prev_count + row_count for prev_count, row_count in zip(prev_counts, row_counts)]
+                    cur_counts[hospital_id] = row_counts
+
+            for r_idx, row in enumerate(hosp_beds_info):
+
+                hospital_id = self.hospital_names.find(row[0])
+                available = cur_counts.get(hospital_id, [0] * num_bed_types)
+
+                for b_idx, bed_type in enumerate(self.bed_types):
+
+                    bed_dif = row[1 + b_idx]
+                    if bed_dif == 0:
+                        continue
+
+                    max_available = max(available[b_idx], available[b_idx] - bed_dif)
+                    for s_idx in self.lookup(hosp_category, hospital_id, bed_type):
+
+                        recipient, min_available = self.subscriptions[s_idx]
+                        if max_available < min_available:
+                            continue
+
+                        # Several subscriptions of a recipient may match the
+                        # same change, it is reported once
+                        category_rows = recipient_tables.setdefault(recipient, {}).setdefault(hosp_category, {})
+                        category_rows.setdefault(r_idx, [row[0]] + [0] * num_bed_types)[1 + b_idx] = bed_dif
+
+        recipient_changes = {}
+        for recipient, category_tables in recipient_tables.items():
+            hosp_categories = list(category_tables)
+            bed_availabiliy = [list(category_tables[hosp_category].values()) for hosp_category in hosp_categories]
+            recipient_changes[recipient] = [hosp_categories, bed_availabiliy]
+
+        return recipient_changes
+
+
+def load_subscription_index(subscriptions_filename, bed_types, hospital_names, logger=logging.root):
+
+    subscription_index = SubscriptionIndex(bed_types, hospital_names, logger)
+    subscription_index.add_all(read_subscriptions(subscriptions_filename))
+
+    logger.info('Loaded %d subscriptions' % (len(subscription_index.subscriptions)))
+
+    return subscription_index
@@ -1,83 +1,271 @@
 import os
+import re
+import glob
+import pickle
+import hashlib
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from pathlib import Path
 import numpy as np
 import openpyxl
+from openpyxl.utils.cell import range_boundaries
+from lxml import etree
 import argparse
 from tabulate import tabulate
 
-parser = argparse.ArgumentParser(description='Script to generate labels file')
-parser.add_argument('--bed_type', type=str, default='HDU', help='what bed type to search for; Gen, HDU, ICU, ICU Ventl')
+from bbmpgov_hospital_registry import HospitalRegistry
 
-args = parser.parse_args()
 
+# Namespaces of the workbook and sheet XML parts
+xlsx_main_ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+xlsx_rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+xlsx_pkg_rel_ns = '{http://schemas.openxmlformats.org/package/2006/relationships}'
 
-def check_merged_cell(sheet_obj, cell_xy):
-    
-    cell = sheet_obj.cell(cell_xy[1], cell_xy[0])
-    for mergedCell in sheet_obj.merged_cells.ranges:
-        if cell.coordinate in mergedCell:
-            return True
-    return False
+req_table_col_header = 'Net Available Beds for C+ Patients'
+
+# Daily sheets are named YYYYMMDD
+date_sheetname_re = re.compile(r'^\d{8}$')
+
+availability_columns = ['date', 'category', 'hospital', 'bed_type', 'available']
+hospital_id_column = 'hospital_id'
+
+# Parsed sheets and their layout are kept on disk for repeated queries
+layout_cache_dirname = '.xlsx_layout_cache'
+layout_cache_max_entries = 64
+
+
+class SheetGrid:
+
+    # Values of a whole sheet, read in one streaming pass, with the same
+    # 1-based (row, column) lookups as sheet_obj.cell(). Cells outside the
+    # sheet read as None
+
+    def __init__(self, values, merged_ranges):
+
+        self.values = values
+        self.max_row, self.max_column = values.shape
+
+        # (min_col, min_row, max_col, max_row) of every merged range
+        self.merged_ranges = merged_ranges
+
+        # Every (column, row) covered by a merged range, mapped to the range
+        self.merged_cells = {}
+        for merged_range in merged_ranges:
+            min_x, min_y, max_x, max_y = merged_range
+            for y in range(min_y, max_y+1):
+                for x in range(min_x, max_x+1):
+                    self.merged_cells[(x, y)] = merged_range
+
+        # Layout found by the searches, kept with the grid in the layout cache
+        self.req_tables = {}
+        self.bed_type_col_idxs = {}
+        self.layout_changed = False
+
+    def value(self, row, column):
+
+        if row < 1 or column < 1 or row > self.max_row or column > self.max_column:
+            return None
+        return self.values[row-1, column-1]
+
+
+def list_sheetnames(filename):
+
+    # Sheet names straight from the workbook XML, without loading the workbook
+    with zipfile.ZipFile(filename) as xlsx_zip:
+        workbook_root = etree.fromstring(xlsx_zip.read('xl/workbook.xml'))
+
+    return [sheet.get('name') for sheet in workbook_root.iter(xlsx_main_ns + 'sheet')]
+
+def find_sheet_xml_path(xlsx_zip, sheetname):
+
+    # The sheet part is found through the workbook relationships
+    workbook_root = etree.fromstring(xlsx_zip.read('xl/workbook.xml'))
+    rels_root = etree.fromstring(xlsx_zip.read('xl/_rels/workbook.xml.rels'))
+
+    rel_id = None
+    for sheet in workbook_root.iter(xlsx_main_ns + 'sheet'):
+        if sheet.get('name') == sheetname:
+            rel_id = sheet.get(xlsx_rel_ns + 'id')
+            break
+
+    for rel in rels_root.iter(xlsx_pkg_rel_ns + 'Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            return target[1:] if target.startswith('/') else 'xl/' + target
+
+    raise KeyError('Worksheet %s does not exist.' % (sheetname))
+
+def read_merged_ranges(filename, sheetname):
+
+    # Read-only worksheets do not expose merged cells, so they are read
+    # straight from the sheet XML
+    merged_ranges = []
+    with zipfile.ZipFile(filename) as xlsx_zip:
+        with xlsx_zip.open(find_sheet_xml_path(xlsx_zip, sheetname)) as sheet_xml:
+            for event, elem in etree.iterparse(sheet_xml, events=('end',)):
+                if elem.tag == xlsx_main_ns + 'mergeCell':
+                    merged_ranges.append(range_boundaries(elem.get('ref')))
+                elif elem.tag == xlsx_main_ns + 'row':
+                    elem.clear()
+
+    return merged_ranges
+
+def load_sheet_grid(filename, sheetname):
+
+    # Stream the sheet once instead of loading the whole workbook
+    wb_obj = openpyxl.load_workbook(filename, read_only=True)
+    try:
+        sheet_obj = wb_obj[sheetname]
+        rows = list(sheet_obj.iter_rows(min_row=1, min_col=1, values_only=True))
+    finally:
+        wb_obj.close()
+
+    num_cols = max([len(row) for row in rows] + [0])
+    values = np.empty((len(rows), num_cols), dtype=object)
+    for r_idx, row in enumerate(rows):
+        values[r_idx, :len(row)] = row
+
+    return SheetGrid(values, read_merged_ranges(filename, sheetname))
+
+class SheetLayoutCache:
+
+    # SheetGrids, with the layout found on them so far, keyed by (workbook
+    # path, mtime, sheet name). Entries hold plain data only, never the
+    # SheetGrid class, which lives in __main__ or __mp_main__ depending on who
+    # wrote it. A hit touches the entry, and the least recently used entries
+    # are removed beyond max_entries
 
-def find_merged_cell_col_range(sheet_obj, total_rows_cols, cell_xy):
+    def __init__(self, cache_dir, max_entries=layout_cache_max_entries):
+
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, filename, sheetname):
+
+        # A changed workbook gets a new key, its old entries age out
+        file_stat = os.stat(filename)
+        key = '%s|%d|%d|%s' % (os.path.abspath(filename), file_stat.st_mtime_ns, file_stat.st_size, sheetname)
+
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    def load(self, filename, sheetname):
+
+        # Anything unreadable, from another version or half written, is a miss
+        cache_path = self.entry_path(filename, sheetname)
+        try:
+            with open(cache_path, 'rb') as f:
+                entry = pickle.load(f)
+            sheet_grid = SheetGrid(entry['values'], [tuple(merged_range) for merged_range in entry['merged_ranges']])
+            sheet_grid.req_tables = dict(entry['req_tables'])
+            sheet_grid.bed_type_col_idxs = dict(entry['bed_type_col_idxs'])
+            os.utime(cache_path)
+        except Exception:
+            return None
+
+        return sheet_grid
+
+    def store(self, filename, sheetname, sheet_grid):
+
+        sheet_grid.layout_changed = False
+
+        entry = {
+            'values': sheet_grid.values,
+            'merged_ranges': [tuple(merged_range) for merged_range in sheet_grid.merged_ranges],
+            'req_tables': sheet_grid.req_tables,
+            'bed_type_col_idxs': sheet_grid.bed_type_col_idxs,
+            }
+
+        cache_path = self.entry_path(filename, sheetname)
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+        self.evict()
+
+    def evict(self):
+
+        cache_paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.pkl')]
+        if len(cache_paths) <= self.max_entries:
+            return
+
+        def access_time(cache_path):
+            try:
+                return os.path.getmtime(cache_path)
+            except OSError:
+                return 0
+
+        cache_paths.sort(key=access_time)
+        for cache_path in cache_paths[:len(cache_paths) - self.max_entries]:
+            try:
+                os.remove(cache_path)
+            except OSError:
+                # Already evicted by another process
+                pass
+
+def load_cached_sheet_grid(filename, sheetname, layout_cache=None):
+
+    if layout_cache is None:
+        return load_sheet_grid(filename, sheetname)
+
+    sheet_grid = layout_cache.load(filename, sheetname)
+    if sheet_grid is None:
+        sheet_grid = load_sheet_grid(filename, sheetname)
+        sheet_grid.layout_changed = True
+
+    return sheet_grid
+
+def check_merged_cell(sheet_grid, cell_xy):
+    return (cell_xy[0], cell_xy[1]) in sheet_grid.merged_cells
+
+def find_merged_cell_col_range(sheet_grid, total_rows_cols, cell_xy):
 
     col_range = []
-    
-    # Store a list of all the merged columns
-    merged_cells_bb_tlbr = []
-    for mergedCell in sheet_obj.merged_cells.ranges:
-        
-        min_x = mergedCell.min_col
-        max_x = mergedCell.max_col
-        min_y = mergedCell.min_row
-        max_y = mergedCell.max_row
-        
-        m_cell_xy = np.array([min_x, min_y])
-        
-        if np.array_equal(m_cell_xy, cell_xy):
-            col_range = [min_x, max_x]
-            
+
+    # Only the range starting at the cell counts
+    merged_range = sheet_grid.merged_cells.get((cell_xy[0], cell_xy[1]))
+    if merged_range is not None and merged_range[0] == cell_xy[0] and merged_range[1] == cell_xy[1]:
+        col_range = [merged_range[0], merged_range[2]]
+
     return col_range
 
-def find_req_tables_start_xy(sheet_obj, total_rows_cols, req_table_col_header):
-    
-    req_tables_start_xy = []
-    for r_idx in range(1, total_rows_cols[0]+1):
-        for c_idx in range(1, total_rows_cols[1]+1):
-            cell_val = sheet_obj.cell(row=r_idx, column=c_idx).value
-            if cell_val is None:
-                continue
-            if cell_val == req_table_col_header:
-                req_tables_start_xy.append([c_idx,r_idx])
-            
+def find_req_tables_start_xy(sheet_grid, total_rows_cols, req_table_col_header):
+
+    # Row major, the same order as a cell by cell scan
+    r_idxs, c_idxs = np.nonzero(sheet_grid.values == req_table_col_header)
+
+    req_tables_start_xy = [[c_idx+1, r_idx+1] for r_idx, c_idx in zip(r_idxs.tolist(), c_idxs.tolist())]
+
     return req_tables_start_xy
 
-def find_hospital_type(sheet_obj, req_tables_start_xy):
-    
+def find_hospital_type(sheet_grid, req_tables_start_xy):
+
     hospital_types = []
-    
+
     for t_xy in req_tables_start_xy:
-        cell_val = sheet_obj.cell(row=t_xy[1]-2, column=1).value
+        cell_val = sheet_grid.value(t_xy[1]-2, 1)
         if cell_val is None:
             continue
         hospital_types.append(cell_val)
-        
+
     return hospital_types
 
-def find_bed_type_col_idx(sheet_obj, row_range, col_range, bed_type):
-    
+def find_bed_type_col_idx(sheet_grid, row_range, col_range, bed_type):
+
     req_col_idx = -1
-    
+
     bed_type_splits = bed_type.split(' ')
     bed_type_len = len(bed_type_splits)
-    
+
     for r_idx in range(row_range[0], row_range[1]+1):
         for c_idx in range(col_range[0], col_range[1]+1):
-            
+
             bed_type_matches = 0
             for b_idx, bed_type in enumerate(bed_type_splits):
-                cell_val = sheet_obj.cell(row=r_idx+b_idx, column=c_idx).value
+                cell_val = sheet_grid.value(r_idx+b_idx, c_idx)
                 if cell_val is None:
                     bed_type_matches = 0
                     continue
@@ -85,93 +273,221 @@ def find_bed_type_col_idx(sheet_obj, row_range, col_range, bed_type):
                     bed_type_matches += 1
                 else:
                     bed_type_matches = 0
-                    
+
             if bed_type_matches == bed_type_len:
                 req_col_idx = c_idx
                 break
 
         if req_col_idx >= 0:
             break
-        
+
     return req_col_idx
-    
-def find_bed_availability(sheet_obj, row_range, col_idx):
-    
+
+def find_bed_availability(sheet_grid, row_range, col_idx):
+
     valid_row_idxs = []
-    
+
     for r_idx in range(row_range[0], row_range[1]):
-        cell_val = sheet_obj.cell(row=r_idx, column=col_idx).value
+        cell_val = sheet_grid.value(r_idx, col_idx)
         if cell_val is None:
             continue
         if cell_val > 0:
             valid_row_idxs.append(r_idx)
-            
+
     return valid_row_idxs
-    
-def display_bed_availability(sheet_obj, valid_row_idxs, disp_col_idxs, hospital_type):
-    
+
+def display_bed_availability(sheet_grid, valid_row_idxs, disp_col_idxs, hospital_type):
+
     table_vals = []
     for r_idx in valid_row_idxs:
-        
+
         row_vals = []
         for c_idx in disp_col_idxs:
-            cell = sheet_obj.cell(row=r_idx, column=c_idx)
-            cell_val = cell.value
+            cell_val = sheet_grid.value(r_idx, c_idx)
             if cell_val is None:
                 continue
             row_vals.append(cell_val)
-            
+
         table_vals.append(row_vals)
-    
+
     if len(table_vals):
         print('')
         print('Hospital Type: %s\n' % (hospital_type))
         print(tabulate(table_vals, headers=["SlNo", "Hospital", "Availability"], numalign="center", stralign="center"))
         print('')
-        
-f_path = Path.cwd() # change to the path to the Excel file
-f_name = 'bbmp_covid19_bed_status.xlsx' # Excel File name
-filename = os.path.join(f_path, f_name)
-sheetname = '20210514' # change to the name of the worksheet
 
-# To open the workbook 
-# workbook object is created
-wb_obj = openpyxl.load_workbook(filename)
 
-# Get workbook active sheet object
-# from the active attribute
-sheet_obj = wb_obj[sheetname]
+def find_req_tables(sheet_grid, req_table_col_header=req_table_col_header):
 
-total_rows_cols = [sheet_obj.max_row, sheet_obj.max_column]
+    # [start xy, row range, column range] of every table on the sheet
+    if req_table_col_header in sheet_grid.req_tables:
+        return sheet_grid.req_tables[req_table_col_header]
 
-start_row = 1
-last_row = total_rows_cols[0]
+    total_rows_cols = [sheet_grid.max_row, sheet_grid.max_column]
 
-bed_type = args.bed_type
+    req_tables_start_xy = find_req_tables_start_xy(sheet_grid, total_rows_cols, req_table_col_header)
 
-req_table_col_header = 'Net Available Beds for C+ Patients'
-req_tables_start_xy = find_req_tables_start_xy(sheet_obj, total_rows_cols, req_table_col_header)
+    req_tables = []
+
+    req_tables_start_xy.append([0, total_rows_cols[0]+1])
+    for t_idx,t_xy in enumerate(req_tables_start_xy[:-1]):
+
+        row_range = [t_xy[1]+1, req_tables_start_xy[t_idx+1][1]]
+
+        if check_merged_cell(sheet_grid, t_xy):
+            col_range = find_merged_cell_col_range(sheet_grid, total_rows_cols, t_xy)
+        else:
+            col_range = [t_xy[0], t_xy[0]]
+
+        req_tables.append([t_xy, row_range, col_range])
+
+    sheet_grid.req_tables[req_table_col_header] = req_tables
+    sheet_grid.layout_changed = True
+
+    return req_tables
+
+def find_table_bed_type_col_idx(sheet_grid, row_range, col_range, bed_type):
+
+    # find_bed_type_col_idx() remembered on the grid
+    key = (row_range[0], row_range[1], col_range[0], col_range[1], bed_type)
+    if key not in sheet_grid.bed_type_col_idxs:
+        sheet_grid.bed_type_col_idxs[key] = find_bed_type_col_idx(sheet_grid, row_range, col_range, bed_type)
+        sheet_grid.layout_changed = True
+
+    return sheet_grid.bed_type_col_idxs[key]
+
+def find_sheet_availability(sheet_grid, bed_types, sheet_date):
+
+    # Tidy [date, category, hospital, bed type, available] rows of every
+    # hospital with beds, for all the bed types in one pass over the tables
+    availability_rows = []
+
+    for t_xy, row_range, col_range in find_req_tables(sheet_grid):
+
+        category = sheet_grid.value(t_xy[1]-2, 1)
+
+        for bed_type in bed_types:
+
+            req_col_idx = find_table_bed_type_col_idx(sheet_grid, row_range, col_range, bed_type)
+            if req_col_idx == -1:
+                continue
+
+            valid_row_idxs = find_bed_availability(sheet_grid, [row_range[0]+2, row_range[1]], req_col_idx)
+            for r_idx in valid_row_idxs:
+                availability_rows.append([sheet_date, category, sheet_grid.value(r_idx, 2), bed_type,
+                                          sheet_grid.value(r_idx, req_col_idx)])
 
-hospital_types = find_hospital_type(sheet_obj, req_tables_start_xy)
+    return availability_rows
 
-req_tables_start_xy.append([0, total_rows_cols[0]+1])
-for t_idx,t_xy in enumerate(req_tables_start_xy[:-1]):
-    
-    row_range = [t_xy[1]+1, req_tables_start_xy[t_idx+1][1]]
+def process_sheet(filename, sheetname, bed_types, cache_dir='', cache_size=layout_cache_max_entries):
+
+    # Runs in a worker process
+    layout_cache = SheetLayoutCache(cache_dir, cache_size) if cache_dir else None
+
+    sheet_grid = load_cached_sheet_grid(filename, sheetname, layout_cache)
+    availability_rows = find_sheet_availability(sheet_grid, bed_types, sheetname)
+
+    if layout_cache is not None and sheet_grid.layout_changed:
+        layout_cache.store(filename, sheetname, sheet_grid)
+
+    return availability_rows
+
+def find_batch_availability(xlsx_paths, bed_types, num_workers=None, cache_dir='', cache_size=layout_cache_max_entries):
+
+    # One tidy table over every date named sheet of every workbook
+    sheet_jobs = []
+    for filename in xlsx_paths:
+        for sheetname in list_sheetnames(filename):
+            if date_sheetname_re.match(sheetname):
+                sheet_jobs.append([filename, sheetname])
+
+    availability_rows = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(process_sheet, filename, sheetname, bed_types, cache_dir, cache_size) for filename, sheetname in sheet_jobs]
+        for (filename, sheetname), future in zip(sheet_jobs, futures):
+            try:
+                availability_rows += future.result()
+            except Exception as err:
+                print('Unable to read sheet %s of %s: %s' % (sheetname, filename, err))
+
+    availability = pd.DataFrame(availability_rows, columns=availability_columns)
+    availability['date'] = pd.to_datetime(availability['date'], format='%Y%m%d')
+
+    # Spellings differ between sheets, the IDs do not. Names are interned a
+    # table at a time, in the order they were read
+    hospital_registry = HospitalRegistry()
+    hospital_names = availability['hospital'].to_numpy()
+    hospital_ids = np.empty(len(availability), dtype=np.int32)
+    table_row_idxs = availability.groupby(['date', 'category', 'bed_type'], sort=False).indices.values()
+    for row_idxs in sorted(table_row_idxs, key=lambda row_idxs: row_idxs[0]):
+        hospital_ids[row_idxs] = hospital_registry.intern_all([str(name) for name in hospital_names[row_idxs]])
+    availability.insert(availability.columns.get_loc('hospital'), hospital_id_column, hospital_ids)
+
+    # Rows of a sheet stay in sheet order
+    return availability.sort_values('date', kind='stable').reset_index(drop=True)
+
+def find_xlsx_paths(batch_path):
+
+    # A directory of workbooks or a glob pattern
+    if os.path.isdir(batch_path):
+        batch_path = os.path.join(batch_path, '*.xlsx')
+
+    return sorted(glob.glob(batch_path))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Script to generate labels file')
+    parser.add_argument('--bed_type', type=str, default='HDU', help='what bed types to search for, comma separated; Gen, HDU, ICU, ICU Ventl')
+    parser.add_argument('--batch', type=str, default='', help='directory or glob of workbooks to read every date named sheet of')
+    parser.add_argument('--num_workers', type=int, default=None, help='number of sheets to read at once in batch mode')
+    parser.add_argument('--output', type=str, default='', help='csv file to save the batch mode table to')
+    parser.add_argument('--cache_dir', type=str, default=layout_cache_dirname, help='where to cache parsed sheets, empty to disable')
+    parser.add_argument('--cache_size', type=int, default=layout_cache_max_entries, help='number of parsed sheets to keep cached')
+
+    args = parser.parse_args()
+
+    bed_types = args.bed_type.split(',')
+
+    if args.batch:
+
+        availability = find_batch_availability(find_xlsx_paths(args.batch), bed_types, args.num_workers,
+                                               args.cache_dir, args.cache_size)
+
+        if args.output:
+            availability.to_csv(args.output, index=False)
+        else:
+            print(tabulate(availability, headers='keys', tablefmt='pretty', showindex=False))
 
-    if check_merged_cell(sheet_obj, t_xy):
-        col_range = find_merged_cell_col_range(sheet_obj, total_rows_cols, t_xy)
     else:
-        col_range = [t_xy[0], t_xy[0]]
-
-    req_col_idx = find_bed_type_col_idx(sheet_obj, row_range, col_range, bed_type)
-    if req_col_idx == -1:
-        continue
-    
-    row_range[0] += 2
-    valid_row_idxs = find_bed_availability(sheet_obj, row_range, req_col_idx)
-    if len(valid_row_idxs) == 0:
-        continue
-
-    disp_col_idxs = [1, 2, req_col_idx]
-    display_bed_availability(sheet_obj, valid_row_idxs, disp_col_idxs, hospital_types[t_idx])
+
+        f_path = Path.cwd() # change to the path to the Excel file
+        f_name = 'bbmp_covid19_bed_status.xlsx' # Excel File name
+        filename = os.path.join(f_path, f_name)
+        sheetname = '20210514' # change to the name of the worksheet
+
+        # Stream the sheet once into a grid, every search below runs on it.
+        # Sheets queried before come from the layout cache
+        layout_cache = SheetLayoutCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+        sheet_grid = load_cached_sheet_grid(filename, sheetname, layout_cache)
+
+        req_tables = find_req_tables(sheet_grid)
+
+        hospital_types = find_hospital_type(sheet_grid, [t_xy for t_xy, row_range, col_range in req_tables])
+
+        for bed_type in bed_types:
+            for t_idx, (t_xy, row_range, col_range) in enumerate(req_tables):
+
+                req_col_idx = find_table_bed_type_col_idx(sheet_grid, row_range, col_range, bed_type)
+                if req_col_idx == -1:
+                    continue
+
+                valid_row_idxs = find_bed_availability(sheet_grid, [row_range[0]+2, row_range[1]], req_col_idx)
+                if len(valid_row_idxs) == 0:
+                    continue
+
+                disp_col_idxs = [1, 2, req_col_idx]
+                display_bed_availability(sheet_grid, valid_row_idxs, disp_col_idxs, hospital_types[t_idx])
+
+        if layout_cache is not None and sheet_grid.layout_changed:
+            layout_cache.store(filename, sheetname, sheet_grid)
@@ -0,0 +1,174 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from bbmpgov_chbms_snapshot import HospitalNames, BedSnapshot
+from bbmpgov_chbms_history import (HistoryWriter, HistoryReader, index_dtype, index_filename, records_filename,
+                                   record_keyframe, record_delta, partition_name)
+
+
+bed_types = ['HDU', 'ICU']
+
+# Noon of two consecutive days, local time like the partitions
+day1_noon = time.mktime((2021, 5, 1, 12, 0, 0, 0, 0, -1))
+day2_noon = time.mktime((2021, 5, 2, 12, 0, 0, 0, 0, -1))
+
+
+def make_snapshot(timestamp, hospital_names, tables, dtype=np.int16):
+
+    # tables is [title, [[hospital name, bed counts...], ...]] per category
+    categories = []
+    hospital_ids = []
+    bed_counts = []
+    for title, rows in tables:
+        categories.append(title)
+        hospital_ids.append(hospital_names.intern_all([row[0] for row in rows]))
+        bed_counts.append(np.array([row[1:] for row in rows], dtype=dtype).reshape(len(rows), len(bed_types)))
+
+    return BedSnapshot(timestamp, bed_types, categories, hospital_ids, bed_counts)
+
+def snapshot_tables(snapshot, hospital_names):
+    return [[title, [list(row) for row in rows]] for title, rows in snapshot.tables_rows(hospital_names)]
+
+def record_headers(reader, partition):
+
+    index = reader.read_index(partition)
+    return [reader.read_record(partition, index[r_idx])[0] for r_idx in range(len(index))]
+
+
+@pytest.fixture
+def history_dir(tmp_path):
+    return str(tmp_path / 'history')
+
+
+def test_deltas_store_changed_rows_or_full_categories(history_dir):
+
+    hospital_names = HospitalNames()
+    tables = [
+        [['Govt', [['Hosp A', 1, 2], ['Hosp B', 3, 4]]], ['Private', [['Hosp C', 5, 6]]]],
+        # One count changed, the same hospitals
+        [['Govt', [['Hosp A', 1, 2], ['Hosp B', 3, 0]]], ['Private', [['Hosp C', 5, 6]]]],
+        # A hospital added
+        [['Govt', [['Hosp A', 1, 2], ['Hosp B', 3, 0]]], ['Private', [['Hosp C', 5, 6], ['Hosp D', 0, 1]]]],
+        ]
+
+    writer = HistoryWriter(history_dir)
+    for s_idx, snapshot_table in enumerate(tables):
+        writer.append(make_snapshot(day1_noon + s_idx, hospital_names, snapshot_table), hospital_names)
+    writer.close()
+
+    reader = HistoryReader(history_dir)
+    headers = record_headers(reader, partition_name(day1_noon))
+    assert [header['kind'] for header in headers] == [record_keyframe, record_delta, record_delta]
+    assert [[category['title'], category['mode'], category['num_rows']] for category in headers[1]['categories']] == [['Govt', 'rows', 1]]
+    assert [[category['title'], category['mode'], category['num_rows']] for category in headers[2]['categories']] == [['Private', 'full', 2]]
+
+    snapshots = list(reader.iter_snapshots())
+    assert [snapshot.timestamp for snapshot in snapshots] == [day1_noon, day1_noon + 1, day1_noon + 2]
+    assert [snapshot_tables(snapshot, reader.hospital_names) for snapshot in snapshots] == tables
+
+def test_rows_delta_widens_the_counts(history_dir):
+
+    hospital_names = HospitalNames()
+    tables = [
+        [['Govt', [['Hosp A', 1, 2], ['Hosp B', 3, 4]]]],
+        [['Govt', [['Hosp A', 1, 2], ['Hosp B', 3, 40000]]]],
+        ]
+
+    writer = HistoryWriter(history_dir)
+    writer.append(make_snapshot(day1_noon, hospital_names, tables[0]), hospital_names)
+    writer.append(make_snapshot(day1_noon + 1, hospital_names, tables[1], dtype=np.int32), hospital_names)
+    writer.close()
+
+    reader = HistoryReader(history_dir)
+    assert record_headers(reader, partition_name(day1_noon))[1]['categories'][0]['mode'] == 'rows'
+
+    snapshot = reader.snapshot_at(day1_noon + 1)
+    assert snapshot.bed_counts[0].dtype == np.int32
+    assert snapshot_tables(snapshot, reader.hospital_names) == tables[1]
+
+def test_orphaned_records_are_ignored(history_dir):
+
+    hospital_names = HospitalNames()
+    tables = [
+        [['Govt', [['Hosp A', 1, 2]]]],
+        [['Govt', [['Hosp A', 0, 2]]]],
+        ]
+
+    writer = HistoryWriter(history_dir)
+    writer.append(make_snapshot(day1_noon, hospital_names, tables[0]), hospital_names)
+    writer.close()
+
+    # A crash after writing a record but before its index entry was complete
+    partition_dir = os.path.join(history_dir, partition_name(day1_noon))
+    with open(os.path.join(partition_dir, records_filename), 'ab') as f:
+        f.write(b'\x10\x00\x00\x00{"kind": 1')
+    with open(os.path.join(partition_dir, index_filename), 'ab') as f:
+        f.write(b'\x00' * (index_dtype.itemsize // 2))
+
+    reader = HistoryReader(history_dir)
+    assert [snapshot_tables(snapshot, reader.hospital_names) for snapshot in reader.iter_snapshots()] == tables[:1]
+
+    # Records appended after the orphan are found through the index
+    writer = HistoryWriter(history_dir)
+    writer.append(make_snapshot(day1_noon + 1, hospital_names, tables[1]), hospital_names)
+    writer.close()
+
+    reader = HistoryReader(history_dir)
+    assert [snapshot_tables(snapshot, reader.hospital_names) for snapshot in reader.iter_snapshots()] == tables
+
+def test_snapshot_at_across_partitions(history_dir):
+
+    hospital_names = HospitalNames()
+    tables = [
+        [['Govt', [['Hosp A', 1, 2]]]],
+        [['Govt', [['Hosp A', 0, 2]]]],
+        [['Govt', [['Hosp A', 0, 2], ['Hosp B', 4, 4]]]],
+        ]
+
+    writer = HistoryWriter(history_dir)
+    writer.append(make_snapshot(day1_noon, hospital_names, tables[0]), hospital_names)
+    writer.append(make_snapshot(day1_noon + 60, hospital_names, tables[1]), hospital_names)
+    writer.append(make_snapshot(day2_noon, hospital_names, tables[2]), hospital_names)
+    writer.close()
+
+    reader = HistoryReader(history_dir)
+    assert reader.partitions() == [partition_name(day1_noon), partition_name(day2_noon)]
+
+    # Every day starts with a keyframe
+    assert record_headers(reader, partition_name(day2_noon))[0]['kind'] == record_keyframe
+
+    assert reader.snapshot_at(day1_noon - 1) is None
+    assert snapshot_tables(reader.snapshot_at(day1_noon + 30), reader.hospital_names) == tables[0]
+
+    # Before the first record of day 2 the last record of day 1 holds
+    assert snapshot_tables(reader.snapshot_at(day2_noon - 60), reader.hospital_names) == tables[1]
+    assert snapshot_tables(reader.snapshot_at(day2_noon + 60), reader.hospital_names) == tables[2]
+
+    snapshots = list(reader.iter_snapshots(day1_noon + 30, day2_noon))
+    assert [snapshot.timestamp for snapshot in snapshots] == [day1_noon + 60, day2_noon]
+
+def test_restart_keeps_the_stored_ids(history_dir):
+
+    hospital_names = HospitalNames()
+    tables = [
+        [['Govt', [['Hosp A', 1, 2], ['Hosp B', 3, 4]]]],
+        [['Govt', [['Hosp B', 3, 4], ['Hosp C', 5, 6], ['Hosp A', 1, 2]]]],
+        ]
+
+    writer = HistoryWriter(history_dir)
+    writer.append(make_snapshot(day1_noon, hospital_names, tables[0]), hospital_names)
+    writer.close()
+
+    # The restarted poller interns the hospitals in another order
+    restarted_names = HospitalNames()
+    writer = HistoryWriter(history_dir)
+    writer.append(make_snapshot(day1_noon + 1, restarted_names, tables[1]), restarted_names)
+    assert writer.id_map.tolist() == [1, 2, 0]
+    writer.close()
+
+    reader = HistoryReader(history_dir)
+    assert reader.hospital_names.names == ['Hosp A', 'Hosp B', 'Hosp C']
+    assert [snapshot_tables(snapshot, reader.hospital_names) for snapshot in reader.iter_snapshots()] == tables
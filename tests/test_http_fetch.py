@@ -0,0 +1,81 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from bbmpgov_http_fetch import FetchClient, ConditionalFetcher
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    # Serves self.server.page = {'body': bytes, 'etag': str} and answers a
+    # matching If-None-Match with a 304
+
+    def do_GET(self):
+
+        page = self.server.page
+        self.server.request_headers.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == page['etag']:
+            self.send_response(304)
+            self.send_header('ETag', page['etag'])
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', page['etag'])
+        self.send_header('Content-Length', str(len(page['body'])))
+        self.end_headers()
+        self.wfile.write(page['body'])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_server():
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.page = {'body': b'<html>beds 1</html>', 'etag': '"v1"'}
+    server.request_headers = []
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def page_fetcher(stand_in_server):
+
+    fetch_client = FetchClient(connect_timeout_sec=2, read_timeout_sec=2, max_retries=0)
+    yield ConditionalFetcher('http://127.0.0.1:%d/' % (stand_in_server.server_address[1]), fetch_client)
+    fetch_client.close()
+
+
+def test_not_modified_returns_none(stand_in_server, page_fetcher):
+
+    assert page_fetcher.fetch() == b'<html>beds 1</html>'
+
+    assert page_fetcher.fetch() is None
+    assert stand_in_server.request_headers[-1].get('If-None-Match') == '"v1"'
+
+def test_same_body_with_new_validators_is_skipped(stand_in_server, page_fetcher):
+
+    assert page_fetcher.fetch() == b'<html>beds 1</html>'
+
+    stand_in_server.page['etag'] = '"v2"'
+    assert page_fetcher.fetch() is None
+
+    # The new validators are still used from then on
+    assert page_fetcher.etag == '"v2"'
+
+def test_changed_body_is_returned(stand_in_server, page_fetcher):
+
+    assert page_fetcher.fetch() == b'<html>beds 1</html>'
+
+    stand_in_server.page.update({'body': b'<html>beds 2</html>', 'etag': '"v2"'})
+    assert page_fetcher.fetch() == b'<html>beds 2</html>'
+    assert page_fetcher.fetch() is None
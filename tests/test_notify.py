@@ -0,0 +1,141 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from bbmpgov_notify import HttpTransport, NotificationDispatcher
+
+
+bed_types = ['HDU', 'ICU']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    # Records every message posted and answers with the next status in
+    # self.server.statuses, 201 once they run out
+
+    def do_POST(self):
+
+        message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        server = self.server
+        with server.lock:
+            status = server.statuses.pop(0) if len(server.statuses) else 201
+            server.posts.append([time.monotonic(), status, message])
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_server():
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.statuses = []
+    server.posts = []
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+def start_dispatcher(server, recipients=('local',), digest_window_sec=0.2, min_message_interval_sec=0.6):
+
+    transport = HttpTransport('http://127.0.0.1:%d/' % (server.server_address[1]), timeout=(2, 2))
+    return NotificationDispatcher(transport, recipients, bed_types, digest_window_sec=digest_window_sec,
+                                  min_message_interval_sec=min_message_interval_sec, max_retries=3,
+                                  backoff_base_sec=0.05, backoff_max_sec=0.1)
+
+def sent_messages(server, status=201):
+
+    with server.lock:
+        return [[post_time, message] for post_time, post_status, message in server.posts if post_status == status]
+
+def wait_for_messages(server, num_messages, timeout_sec=5):
+
+    end_time = time.monotonic() + timeout_sec
+    while len(sent_messages(server)) < num_messages and time.monotonic() < end_time:
+        time.sleep(0.02)
+
+    return sent_messages(server)
+
+
+def test_changes_are_coalesced_into_one_digest(stand_in_server):
+
+    dispatcher = start_dispatcher(stand_in_server)
+    dispatcher.notify(['Govt Hospitals'], [[['Hosp A', 1, 0]]])
+    dispatcher.notify(['Govt Hospitals'], [[['Hosp A', 2, 1]]])
+    dispatcher.notify(['Private Hospitals'], [[['Hosp B', 0, -1]]])
+
+    messages = wait_for_messages(stand_in_server, 1)
+    dispatcher.close()
+
+    assert len(messages) == 1
+    body = messages[0][1]['body']
+    assert messages[0][1]['to'] == 'local'
+    assert 'Hosp A: HDU +3, ICU +1' in body
+    assert 'Hosp B: ICU -1' in body
+
+def test_changes_that_cancel_out_send_nothing(stand_in_server):
+
+    dispatcher = start_dispatcher(stand_in_server)
+    dispatcher.notify(['Govt Hospitals'], [[['Hosp A', 1, 0]]])
+    dispatcher.notify(['Govt Hospitals'], [[['Hosp A', -1, 0]]])
+
+    time.sleep(0.5)
+    dispatcher.close()
+
+    assert stand_in_server.posts == []
+
+def test_unavailable_endpoint_is_retried(stand_in_server):
+
+    stand_in_server.statuses = [503, 503]
+
+    dispatcher = start_dispatcher(stand_in_server)
+    dispatcher.notify(['Govt Hospitals'], [[['Hosp A', 1, 0]]])
+
+    messages = wait_for_messages(stand_in_server, 1)
+    dispatcher.close()
+
+    assert len(messages) == 1
+    assert 'Hosp A: HDU +1' in messages[0][1]['body']
+    assert [post[1] for post in stand_in_server.posts] == [503, 503, 201]
+
+def test_rejected_digest_is_dropped(stand_in_server):
+
+    stand_in_server.statuses = [400]
+
+    dispatcher = start_dispatcher(stand_in_server)
+    dispatcher.notify(['Govt Hospitals'], [[['Hosp A', 1, 0]]])
+
+    time.sleep(0.5)
+    dispatcher.close()
+
+    assert [post[1] for post in stand_in_server.posts] == [400]
+
+def test_messages_to_a_recipient_are_rate_limited(stand_in_server):
+
+    dispatcher = start_dispatcher(stand_in_server, recipients=[])
+    dispatcher.notify_recipients({'a': [['Govt Hospitals'], [[['Hosp A', 1, 0]]]]})
+    messages = wait_for_messages(stand_in_server, 1)
+
+    # Changes for a recipient already messaged wait out the interval, others
+    # go out after the digest window
+    dispatcher.notify_recipients({'a': [['Govt Hospitals'], [[['Hosp A', 1, 0]]]],
+                                  'b': [['Govt Hospitals'], [[['Hosp B', 1, 0]]]]})
+    messages = wait_for_messages(stand_in_server, 3)
+    dispatcher.close()
+
+    assert [message['to'] for post_time, message in messages] == ['a', 'b', 'a']
+    assert messages[2][0] - messages[0][0] >= 0.6 - 0.05
+    assert messages[1][0] - messages[0][0] < 0.6